@@ -0,0 +1,121 @@
+# async_db.py
+
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from db import DB_POOL_MAX
+
+# 执行数据库调用的线程数：默认与连接池上限一致，避免线程多于可借连接
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX)))
+
+_executor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db"
+        )
+    return _executor
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    在有界线程池中执行同步的数据库函数并 await 结果，例如：
+
+        bets = await run_db(get_locked_bets_for_date, group_id, date_str)
+
+    handler 在等待查询时会让出事件循环，其它群组的更新照常处理。
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+def shutdown():
+    """等待进行中的查询结束并关闭线程池"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+# ---------- 本地测试 ----------
+if __name__ == "__main__":
+    import sqlite3
+    import tempfile
+    import threading
+
+    import db
+
+    # 模拟 8 个群同时发起耗时 0.2s 的查询：串行需 1.6s，放进线程池后应重叠执行
+    def slow_query(i):
+        time.sleep(0.2)
+        return i
+
+    async def main():
+        start = time.perf_counter()
+        results = await asyncio.gather(*(run_db(slow_query, i) for i in range(8)))
+        elapsed = time.perf_counter() - start
+        print(f"8 个查询完成：{results}，耗时 {elapsed:.2f}s")
+        assert results == list(range(8))
+        assert elapsed < 0.2 * 8 / 2, "查询没有并发执行"
+
+        # 查询进行中事件循环仍能响应
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        t = asyncio.create_task(ticker())
+        await run_db(slow_query, 0)
+        t.cancel()
+        print(f"查询期间事件循环执行了 {ticks} 次 tick")
+        assert ticks > 5, "事件循环被阻塞"
+
+    # 真实 SQLite（临时库）：另一个进程持有写锁时，确认下注的 handler 在写库处等锁，
+    # 同时另一个群查看 code 的 handler 照常读完（WAL 下读不挡写）
+    def hold_write_lock(seconds):
+        other = sqlite3.connect(db.SQLITE_PATH, isolation_level=None, check_same_thread=False)
+        other.execute("BEGIN IMMEDIATE")
+        threading.Timer(seconds, lambda: (other.execute("COMMIT"), other.close())).start()
+
+    async def main_sqlite():
+        db.init_db()
+        bets = [{"date": "2030-01-01", "markets": ["M"], "number": "1234", "type": "B", "mode": "",
+                 "amount": 1, "potential_win": 0, "commission": 0}]
+        await run_db(db.insert_bets, bets, 0, 2, "READ")
+
+        done = {}
+
+        async def handler(name, func, *args):
+            result = await run_db(func, *args)
+            done[name] = time.perf_counter() - start
+            return result
+
+        hold_write_lock(0.3)
+        start = time.perf_counter()
+        ids, codes = await asyncio.gather(
+            handler("confirm", db.insert_bets, bets, 0, 1, "WRITE"),
+            handler("codes", db.get_recent_bet_codes, 2),
+        )
+        print(f"SQLite 两个 handler：确认下注等写锁 {done['confirm'] * 1000:.0f} ms，"
+              f"同时查看 code {done['codes'] * 1000:.0f} ms 完成")
+        assert len(ids) == 1 and codes == ["READ"]
+        assert done["confirm"] >= 0.25, "写库没有等到写锁释放"
+        assert done["codes"] < 0.1, "读库被等写锁的 handler 挡住"
+
+    asyncio.run(main())
+
+    db.SQLITE_PATH = os.path.join(tempfile.mkdtemp(prefix="4d-async-"), "async.db")
+    asyncio.run(main_sqlite())
+    shutdown()
+    db.close_pool()
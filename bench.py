@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+"""
+本地性能测试。
+
+用法：
+    python bench.py            # 跑全部
+    python bench.py insert     # 只跑某一项
+
+未设置 DATABASE_URL 时使用临时 SQLite 文件，不会碰到 data.db。
+"""
+import os
+import sys
+import tempfile
+import time
+
+import re
+
+if not os.getenv("DATABASE_URL"):
+    os.environ.setdefault(
+        "SQLITE_PATH", os.path.join(tempfile.mkdtemp(prefix="4d-bench-"), "bench.db")
+    )
+
+import db
+import parser
+from engine import calculate
+from parser import parse_bet_text
+
+
+def _best_of(fn, repeat=5):
+    """多次执行取最快一次（秒）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _make_slip(n):
+    """生成 n 笔注单"""
+    lines = ["08/06", "MKT"]
+    lines += [f"{i % 10000:04d}-1B 2S" for i in range(0, n, 2)]
+    bets = parse_bet_text("\n".join(lines))[:n]
+    calculate(bets)
+    return bets
+
+
+def _insert_loop(bets, agent_id, group_id, code):
+    """
+    对照组：注单逐行 execute（旧写法）。其余写入与 db.insert_bets 完全相同
+    （登记 code、累加每日佣金和号码赔付，同一个写线程 / 事务），两边只差注单怎么写
+    """
+    totals, exposure = {}, {}
+    rows = list(db._tally_rows((db._bet_row(bet, agent_id, group_id, code) for bet in bets), totals, exposure))
+    sql = db._sql(
+        f"INSERT INTO bets ({db.BET_COLUMNS}) "
+        f"VALUES ({', '.join(['%s'] * len(db.BET_COLUMNS.split(',')))})"
+    )
+
+    def write(cursor):
+        for row in rows:
+            cursor.execute(sql, row)
+        db.run_query(cursor, db._Q_SLIP_INSERT, (str(group_id), code, str(min(totals, key=str))))
+        db._add_daily_commission(cursor, group_id, totals)
+        db._add_exposure(cursor, exposure)
+
+    db._write(db._conn_key(group_id), write)
+
+
+def bench_insert():
+    db.init_db()
+    print("批量写入注单（逐行 execute vs 单语句批量，两边的其它写入相同）")
+    for n in (10, 100, 1000):
+        bets = _make_slip(n)
+        # 两边交替执行：表越写越大，先跑完一边再跑另一边会让后跑的吃亏
+        loop = bulk = float("inf")
+        for _ in range(5):
+            loop = min(loop, _best_of(lambda: _insert_loop(bets, 1, "bench", "LOOP"), repeat=1))
+            bulk = min(bulk, _best_of(lambda: db.insert_bets(bets, 1, "bench", "BULK"), repeat=1))
+        print(f"  {n:>5} 笔：逐行 {loop * 1000:8.2f} ms  批量 {bulk * 1000:8.2f} ms  "
+              f"x{loop / bulk:.1f}")
+
+
+def bench_settle():
+    """一个开奖日 BENCH_SETTLE_BETS 笔注单（默认 100 万）的整日结算"""
+    import random
+    db.init_db()
+    n = int(os.getenv("BENCH_SETTLE_BETS", "1000000"))
+    bet_date = "2030-01-01"
+    rng = random.Random(4)
+
+    existing = 0
+    for conn in db._each_conn():
+        c = conn.cursor()
+        c.execute(db._sql("SELECT COUNT(*) FROM bets WHERE bet_date = %s"), (bet_date,))
+        existing += c.fetchone()[0]
+
+    start = time.perf_counter()
+    for chunk in range(existing, n, 10000):
+        bets = [
+            {
+                "date": bet_date,
+                "markets": rng.sample("MKTSHE", rng.randint(1, 3)),
+                "number": f"{rng.randrange(10000):04d}",
+                "type": rng.choice("BSAC"),
+                "mode": rng.choice([None, None, None, "box", "ibox"]),
+                "amount": 1,
+                "potential_win": 0,
+                "commission": 0,
+            }
+            for _ in range(min(10000, n - chunk))
+        ]
+        db.insert_bets(bets, 1, f"g{chunk // 10000 % 500}", "BENCH")
+    if n > existing:
+        print(f"  写入 {n - existing} 笔注单：{time.perf_counter() - start:.1f}s")
+
+    for market in "MKTSHE":
+        numbers = [f"{rng.randrange(10000):04d}" for _ in range(23)]
+        draw_text = (
+            f"1st: {numbers[0]}\n2nd: {numbers[1]}\n3rd: {numbers[2]}\n"
+            f"Special: {' '.join(numbers[3:13])}\nConsolation: {' '.join(numbers[13:])}"
+        )
+        db.save_result_to_db(bet_date, market, draw_text)
+
+    print(f"整日结算（{n} 笔注单，6 个市场）")
+    winnings = []
+    elapsed = _best_of(lambda: winnings.append(db.settle(bet_date)), repeat=3)
+    print(f"  所有群：{elapsed:.3f}s，中奖 {len(winnings[-1])} 行")
+    elapsed = _best_of(lambda: db.settle(bet_date, group_id="g1"), repeat=3)
+    print(f"  单个群：{elapsed * 1000:.1f} ms")
+
+
+def _confirm_init(barrier):
+    global _confirm_barrier
+    _confirm_barrier = barrier
+    db.init_db()
+
+
+def _confirm_worker(worker):
+    """子进程：给自己的 8 个群逐张确认注单（每张一个事务），返回 (开始, 结束) 时间"""
+    slip = _make_slip(int(os.getenv("BENCH_CONFIRM_SLIP", "20")))
+    n = int(os.getenv("BENCH_CONFIRMS", "200"))
+    _confirm_barrier.wait()
+    start = time.time()
+    for i in range(n):
+        db.insert_bets(slip, 1, f"-100{worker}{i % 8}", f"W{worker}-{i}")
+    end = time.time()
+    db.close_pool()
+    return start, end
+
+
+def bench_confirm():
+    """多进程并发确认下注：单个 SQLite 文件 vs 按群分片（SQLITE_SHARDS）"""
+    import multiprocessing
+
+    if db.USE_PG:
+        print("并发确认：只对比 SQLite 单文件 / 分片，DATABASE_URL 已设置，跳过")
+        return
+    procs = int(os.getenv("BENCH_CONFIRM_PROCS", "8"))
+    n = int(os.getenv("BENCH_CONFIRMS", "200"))
+    ctx = multiprocessing.get_context("spawn")
+    # 分片只是把写锁拆开，多出来的吞吐要靠多核并行写入；单核机器上提升有限
+    print(f"并发确认下注（{procs} 个进程 × {n} 张注单，每张一个事务，本机 {os.cpu_count()} 个 CPU）")
+    baseline = None
+    for shards in (0, int(os.getenv("BENCH_SHARDS", "8"))):
+        # 子进程按环境变量导入 db：每种配置一个新目录
+        os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="4d-bench-"), "confirm.db")
+        os.environ["SQLITE_SHARDS"] = str(shards)
+        barrier = ctx.Barrier(procs)
+        with ctx.Pool(procs, initializer=_confirm_init, initargs=(barrier,)) as pool:
+            spans = pool.map(_confirm_worker, range(procs))
+        elapsed = max(e for _, e in spans) - min(s for s, _ in spans)
+        rate = procs * n / elapsed
+        label = f"{shards} 个分片" if shards else "单文件"
+        speedup = f"  x{rate / baseline:.1f}" if baseline else ""
+        print(f"  {label:8s}：{elapsed:6.2f}s  {rate:8.0f} 张/s{speedup}")
+        baseline = baseline or rate
+
+
+def _mixed_run():
+    """子进程：BENCH_MIXED_GROUPS 个群、BENCH_MIXED_THREADS 个线程读写混合 BENCH_MIXED_SECONDS 秒"""
+    import random
+    import threading
+
+    db.init_db()
+    groups = [f"-100{i}" for i in range(int(os.getenv("BENCH_MIXED_GROUPS", "200")))]
+    threads = int(os.getenv("BENCH_MIXED_THREADS", "16"))
+    seconds = float(os.getenv("BENCH_MIXED_SECONDS", "5"))
+    slip = _make_slip(10)
+    bet_date = slip[0]["date"]
+    for g in groups:
+        db.insert_bets(slip, 1, g, "SEED")
+
+    latencies = {"read": [], "confirm": [], "delete": []}
+    errors = []
+    deadline = time.perf_counter() + seconds
+
+    def client(worker):
+        rng = random.Random(worker)
+        mine = []
+        n = 0
+        while time.perf_counter() < deadline:
+            g = rng.choice(groups)
+            r = rng.random()
+            start = time.perf_counter()
+            try:
+                if r < 0.6:
+                    kind = "read"
+                    db.get_bet_code_page(g)
+                    db.get_commission_summary(bet_date, bet_date, g)
+                    db.get_locked_bets_for_date(g, bet_date)
+                elif r < 0.85 or not mine:
+                    # 确认下注：存入待确认 → 取出 → 写注单
+                    kind = "confirm"
+                    n += 1
+                    db.put_pending_slip(g, n, worker, "x", time.time() + 60)
+                    db.take_pending_slip(g, n, worker)
+                    code = f"M{worker}-{n}"
+                    db.insert_bets(slip, 1, g, code)
+                    mine.append((code, g))
+                else:
+                    kind = "delete"
+                    code, g = mine.pop(rng.randrange(len(mine)))
+                    if not db.delete_bet_and_commission(code, g):
+                        raise RuntimeError(f"删除 {code} 失败")
+            except Exception as e:
+                errors.append(repr(e))
+                continue
+            latencies[kind].append(time.perf_counter() - start)
+
+    pool = [threading.Thread(target=client, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    stats = db.pool_stats()
+    db.close_pool()
+
+    def pct(xs, p):
+        xs = sorted(xs)
+        return xs[min(len(xs) - 1, int(len(xs) * p))] * 1000 if xs else 0.0
+
+    return {
+        "ops": sum(len(v) for v in latencies.values()) / seconds,
+        "latency": {k: (len(v), pct(v, 0.5), pct(v, 0.95)) for k, v in latencies.items()},
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "batches": stats.get("batches"),
+        "writes": stats.get("writes"),
+    }
+
+
+def bench_mixed():
+    """多群读写混合：旧的 SQLite 用法（默认日志模式、各线程直接写）vs 写线程 + WAL"""
+    import multiprocessing
+
+    if db.USE_PG:
+        print("读写混合：只对比 SQLite 引擎，DATABASE_URL 已设置，跳过")
+        return
+    configs = [
+        ("旧方式", {"SQLITE_WRITER": "0", "SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "FULL",
+                    "SQLITE_MMAP_SIZE": "0", "SQLITE_CACHE_SIZE": "-2000", "SQLITE_BUSY_TIMEOUT": "5"}),
+        ("写线程+WAL", {}),
+    ]
+    print(f"读写混合（{os.getenv('BENCH_MIXED_GROUPS', '200')} 个群，{os.getenv('BENCH_MIXED_THREADS', '16')} 个线程；"
+          f"60% 读 / 25% 确认 / 15% 删除）")
+    ctx = multiprocessing.get_context("spawn")
+    baseline = None
+    for label, env in configs:
+        saved = {k: os.environ.get(k) for k in env}
+        os.environ.update(env)
+        os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="4d-bench-"), "mixed.db")
+        try:
+            with ctx.Pool(1) as pool:
+                r = pool.apply(_mixed_run)
+        finally:
+            for k, v in saved.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+        lat = "  ".join(f"{k} p50 {p50:.1f} / p95 {p95:.1f} ms" for k, (_, p50, p95) in r["latency"].items())
+        speedup = f"  x{r['ops'] / baseline:.1f}" if baseline else ""
+        batching = f"  平均每批 {r['writes'] / r['batches']:.1f} 个写操作" if r["batches"] else ""
+        print(f"  {label:10s}：{r['ops']:7.0f} 操作/s{speedup}  错误 {r['errors']}{batching}")
+        print(f"  {'':10s}  {lat}")
+        if r["first_error"]:
+            print(f"  {'':10s}  首个错误：{r['first_error']}")
+        baseline = baseline or r["ops"]
+
+
+def bench_perms():
+    """组合数 / 排列键 / 排列列表：逐次计算 vs 预计算表"""
+    from collections import Counter
+    from itertools import permutations
+    import math
+    import engine
+
+    def old_comb(number):
+        cnt = Counter(number)
+        comb = math.factorial(4)
+        for c in cnt.values():
+            comb //= math.factorial(c)
+        return comb
+
+    numbers = [f"{n:04d}" for n in range(10000)]
+    engine._perm_tables()   # 构建时间单独统计
+    start = time.perf_counter()
+    engine._PERM_LIST = None
+    engine._perm_tables()
+    print(f"排列表（0000–9999）构建：{(time.perf_counter() - start) * 1000:.1f} ms")
+
+    cases = [
+        ("组合数", lambda: [old_comb(n) for n in numbers],
+                  lambda: [engine.combination_count(n) for n in numbers]),
+        ("排列列表", lambda: [{int("".join(p)) for p in permutations(n)} for n in numbers],
+                    lambda: [engine.permutations_of(n) for n in numbers]),
+    ]
+    for name, old, new in cases:
+        t_old = _best_of(old)
+        t_new = _best_of(new)
+        print(f"  {name} x10000：逐次 {t_old * 1000:7.2f} ms  查表 {t_new * 1000:7.2f} ms  "
+              f"x{t_old / t_new:.1f}")
+
+    bets = _make_slip(5000)
+    print(f"  calculate 5000 笔：{_best_of(lambda: calculate(bets)) * 1000:.2f} ms")
+
+
+def bench_columns():
+    """calculate（逐注 dict）vs calculate_columns（NumPy 列式）"""
+    import random
+    from engine import BET_TYPES, MODES, calculate_columns, to_columns
+
+    rng = random.Random(5)
+    print("批量计价（逐注 dict vs 列式向量化）")
+    for n in (5000, 100000):
+        bets = [
+            {
+                "number": f"{rng.randrange(10000):04d}",
+                "type": rng.choice(BET_TYPES[:2]),
+                "mode": rng.choice(MODES),
+                "amount": rng.randint(1, 20),
+                "markets": rng.sample("MKTSHE", rng.randint(1, 3)),
+            }
+            for _ in range(n)
+        ]
+        cols = to_columns(bets)
+        t_dict = _best_of(lambda: calculate(bets), repeat=3)
+        t_cols = _best_of(lambda: calculate_columns(**cols), repeat=3)
+        assert calculate(bets)["total_commission"] == calculate_columns(**cols)["total_commission"]
+        print(f"  {n:>6} 笔：dict {t_dict * 1000:8.2f} ms  列式 {t_cols * 1000:7.2f} ms  "
+              f"x{t_dict / t_cols:.1f}")
+
+
+def _reference_iter_bet_text(
+    text: str,
+    default_year: int = 2025,
+    unparsed: list = None,
+):
+    """旧版逐 token 双正则实现（对照组，输出应与 parser.iter_bet_text 完全一致）"""
+    lines = [(no, line) for no, line in enumerate(text.splitlines(), start=1) if line.strip()]
+    if len(lines) < 3:
+        raise ValueError("格式错误：至少需要日期、市场行、下注行")
+
+    date_str = None
+    markets = None
+    expect_markets = False
+
+    for line_no, raw in lines:
+        line = raw.strip()
+
+        # 1. 日期行：开始新区块，下一行必须是市场行
+        new_date = parser._parse_date_line(line, default_year)
+        if new_date is not None:
+            date_str = new_date
+            expect_markets = True
+            continue
+        if date_str is None:
+            raise ValueError(f"无效日期格式：{line}")
+
+        # 2. 市场行
+        if expect_markets or parser._is_market_line(line):
+            markets = parser._parse_market_line(line)
+            expect_markets = False
+            continue
+
+        # 3. 下注行，拆出每笔注单
+        tokens = [(m.start() + 1, m.group()) for m in re.finditer(r"\S+", raw)]
+        # 检查是否有特殊模式 ibox/box
+        mode = None
+        if tokens[-1][1].lower() in ("ibox", "box"):
+            mode = tokens[-1][1].lower()
+            tokens = tokens[:-1]
+
+        current_number = None
+        for col, tok in tokens:
+            # 格式：号码-金额类型，例如 "1526-1B"
+            m_full = re.match(r"^(\d{1,4})-(\d+)([BSAC])$", tok, re.IGNORECASE)
+            if m_full:
+                num, amt, t = m_full.groups()
+
+                if mode and t.upper() not in ("B", "S"):
+                    raise ValueError(f"模式“{mode}”只能用于 B/S 类型下注，无法用于 {t.upper()}。")
+
+                current_number = num.zfill(4)
+                yield {
+                    "date": date_str,
+                    "markets": markets,
+                    "number": current_number,
+                    "type": t.upper(),
+                    "mode": mode,
+                    "amount": int(amt)
+                }
+                continue
+
+            # 格式：金额类型，例如 "1S"
+            m_part = re.match(r"^(\d+)([BSAC])$", tok, re.IGNORECASE)
+            if m_part:
+                if current_number is None:
+                    raise ValueError(f"未指定号码，无法解析：{tok}")
+                amt, t = m_part.groups()
+                if mode and t.upper() not in ("B", "S"):
+                    raise ValueError(f"模式“{mode}”只能用于 B/S 类型下注，无法用于 {t.upper()}。")
+                yield {
+                    "date": date_str,
+                    "markets": markets,
+                    "number": current_number,
+                    "type": t.upper(),
+                    "mode": mode,
+                    "amount": int(amt)
+                }
+                continue
+
+            # 无法识别的 token：记录位置
+            if unparsed is not None:
+                unparsed.append((line_no, col, tok))
+
+
+def _slip_corpus(rng, n_slips, lines_per_slip=(5, 60)):
+    """模拟代理贴的注单：多日期 / 多市场区块、追加金额、box / ibox"""
+    slips = []
+    for _ in range(n_slips):
+        lines = []
+        for _ in range(rng.randint(1, 3)):
+            lines.append(f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}")
+            lines.append("".join(rng.sample("MKTSHE", rng.randint(1, 4))))
+            for _ in range(rng.randint(*lines_per_slip) // 3):
+                number = f"{rng.randrange(10000):0{rng.choice([4, 4, 4, 3])}d}"
+                mode = rng.choice(["", "", "", " box", " ibox"])
+                types = "BS" if mode else "BSAC"
+                parts = [f"{number}-{rng.randint(1, 20)}{rng.choice(types)}"]
+                parts += [f"{rng.randint(1, 20)}{rng.choice(types)}" for _ in range(rng.randint(0, 2))]
+                lines.append(" ".join(parts) + mode)
+        slips.append("\n".join(lines))
+    return slips
+
+
+def _fuzz_text(rng):
+    """随机拼凑的文本：合法 token、大小写、噪声、全角数字、空白混杂"""
+    pieces = [
+        "08/06", "9/6", "31/12", "MKT", "he", "M K", "box", "ibox", "BOX", "IBox",
+        "1234-1B", "12-3s", "12345-1B", "1S", "2c", "10A", "-1B", "1B-", "1234-1X",
+        "0001-01b", "１２３４-１B", "1234-1B5S", "abc", "??", "1/1", "99/99", "1234",
+    ]
+    seps = [" ", "  ", "\t", "\n", "\n\n", " \n"]
+    out = ["08/06", "\n", "MKT", "\n"]
+    for _ in range(rng.randint(1, 40)):
+        out.append(rng.choice(pieces))
+        out.append(rng.choice(seps))
+    return "".join(out)
+
+
+def _parse_outcome(fn, text):
+    unparsed = []
+    try:
+        return list(fn(text, unparsed=unparsed)), unparsed
+    except ValueError as e:
+        return "ValueError", str(e)
+
+
+def bench_parser():
+    """解析器：与旧实现逐项比对 + 吞吐量"""
+    import random
+    from parser import iter_bet_text
+
+    rng = random.Random(13)
+
+    samples = [
+        "08/06\nMKT\n1526-1B 1S ibox\n",
+        "09/06\nMS\n1234-2C box 5A\n",
+        "08/06\nMKT\n1526-1B 1S ibox\nHE\n1234-2C ??\n09/06\nM\n5678-1B\n",
+    ]
+    fuzz = [_fuzz_text(rng) for _ in range(20000)]
+    corpus = _slip_corpus(rng, 300)
+    for text in samples + fuzz + corpus:
+        assert _parse_outcome(iter_bet_text, text) == _parse_outcome(_reference_iter_bet_text, text), text
+    print(f"解析结果与旧实现一致：{len(samples)} 个样例 + {len(fuzz)} 条 fuzz + {len(corpus)} 张注单")
+
+    n_bets = sum(len(list(iter_bet_text(t))) for t in corpus)
+    t_old = _best_of(lambda: [list(_reference_iter_bet_text(t)) for t in corpus])
+    t_new = _best_of(lambda: [list(iter_bet_text(t)) for t in corpus])
+    print(f"  {len(corpus)} 张注单 / {n_bets} 笔：旧 {t_old * 1000:.1f} ms ({n_bets / t_old:,.0f} 笔/s)  "
+          f"新 {t_new * 1000:.1f} ms ({n_bets / t_new:,.0f} 笔/s)  x{t_old / t_new:.1f}")
+
+
+BENCHES = {
+    "insert": bench_insert,
+    "settle": bench_settle,
+    "confirm": bench_confirm,
+    "mixed": bench_mixed,
+    "perms": bench_perms,
+    "columns": bench_columns,
+    "parser": bench_parser,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        BENCHES[name]()
+    db.close_pool()
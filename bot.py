@@ -4,16 +4,11 @@ import logging
 import random
 import string
 import pytz
-import threading
-from utils import check_group_winning
-from db import get_locked_bets_for_date
-from db import USE_PG,save_result_to_db,get_result_by_date
+from utils import check_group_winning, price_slip, slip_cache_stats
+from db import USE_PG,save_result_to_db,get_recorded_markets,get_group_winning_bets,results_cache_stats
 from db import init_db
 init_db()
 from collections import OrderedDict
-from telegram import CallbackQuery
-from collections import defaultdict
-from telegram.constants import ParseMode
 from datetime import date, timedelta, datetime,time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -24,15 +19,24 @@ from telegram.ext import (
     ContextTypes,
     filters
 )
-from parser import parse_bet_text
-from engine import calculate,STANDARD_ODDS
+from parser import parse_result_input, format_result_text
 from db import (
-    get_conn,
     get_commission_summary,
     get_bet_history,
     get_recent_bet_codes,
-    delete_bet_and_commission
+    get_bet_code_page,
+    delete_bet_and_commission,
+    get_code_bet_date,
+    get_duplicate_bets,
+    insert_bets,
+    check_exposure,
+    ExposureLimitExceeded,
+    pool_stats,
+    close_pool
 )
+from async_db import run_db, shutdown as shutdown_executor
+from pending import PendingSlipTooLarge, pending_stats, put_pending, take_pending
+from update_processor import ChatOrderedUpdateProcessor, UPDATE_CONCURRENCY
 logger = logging.getLogger(__name__)
 
 # 日志配置
@@ -42,11 +46,17 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 判断是否使用 Postgres 参数风格
-USE_PG = bool(os.getenv("DATABASE_URL"))
-
 ALLOWED_ADMIN_ID = 1392912618
 
+# 录入开奖成绩的格式示例（每个奖项一行）
+RESULT_INPUT_EXAMPLE = (
+    "1st: 1234\n"
+    "2nd: 5678\n"
+    "3rd: 9012\n"
+    "Special: 1111 2222 3333 ...\n"
+    "Consolation: 4444 5555 6666 ..."
+)
+
 async def show_personal_menu(update, context):
     keyboard = [
         [InlineKeyboardButton("🎯 输入中奖成绩", callback_data="input_result")]
@@ -76,7 +86,7 @@ async def handle_personal_menu(update: Update, context: ContextTypes.DEFAULT_TYP
         context.user_data["result_market"] = market
         context.user_data["awaiting_result_input"] = True
 
-        await query.edit_message_text(f"你选择了 {market}。\n请输入今日的中奖成绩（以空格分隔）：\n\n例如：1234 5678 9012")
+        await query.edit_message_text(f"你选择了 {market}。\n请输入今日的中奖成绩（每个奖项一行，号码以空格分隔）：\n\n例如：\n{RESULT_INPUT_EXAMPLE}")
 
 async def handle_result_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -89,40 +99,19 @@ async def handle_result_input(update: Update, context: ContextTypes.DEFAULT_TYPE
     if context.user_data.get("awaiting_result_input") and "result_market" in context.user_data:
         market = context.user_data["result_market"]
         text = update.message.text.strip()
-        lines = text.splitlines()
-
-        result_data = {
-            "1st": "",
-            "2nd": "",
-            "3rd": "",
-            "special": [],
-            "consolation": []
-        }
-
-        for line in lines:
-            if line.lower().startswith("1st:"):
-                result_data["1st"] = line.split(":", 1)[1].strip()
-            elif line.lower().startswith("2nd:"):
-                result_data["2nd"] = line.split(":", 1)[1].strip()
-            elif line.lower().startswith("3rd:"):
-                result_data["3rd"] = line.split(":", 1)[1].strip()
-            elif line.lower().startswith("special:"):
-                result_data["special"] = line.split(":", 1)[1].strip().split()
-            elif line.lower().startswith("consolation:"):
-                result_data["consolation"] = line.split(":", 1)[1].strip().split()
-
-        # 格式化为统一格式再保存
-        result_text = (
-            f"1st: {result_data['1st']}\n"
-            f"2nd: {result_data['2nd']}\n"
-            f"3rd: {result_data['3rd']}\n"
-            f"Special: {' '.join(result_data['special'])}\n"
-            f"Consolation: {' '.join(result_data['consolation'])}"
-        )
+
+        # 只解析一次：结构化结果写 draw_numbers，格式化文本写 results
+        try:
+            draw = parse_result_input(text)
+        except ValueError as e:
+            # 格式不对不入库，保留等待状态让管理员重新输入
+            await update.message.reply_text(f"❌ 格式错误：{e}\n\n请按以下格式重新输入：\n{RESULT_INPUT_EXAMPLE}")
+            return
+        result_text = format_result_text(draw)
 
         # 保存逻辑（你可以改成存数据库或文件）
         today_str = datetime.now().strftime("%Y-%m-%d")
-        save_result_to_db(today_str, market, result_text)
+        await run_db(save_result_to_db, today_str, market, result_text, draw)
 
         # 清理状态
         context.user_data.pop("awaiting_result_input", None)
@@ -142,58 +131,15 @@ async def handle_check_winning(update: Update, context: ContextTypes.DEFAULT_TYP
 
     group_id = update.effective_chat.id
     today_str = datetime.now().strftime("%Y-%m-%d")
-    bets = get_locked_bets_for_date(group_id, today_str)
-    
-    market_results = {}
-    markets = set()
-    for bet in get_locked_bets_for_date(group_id, today_str):
-        for m in bet["market"].split(","):
-            markets.add(m.strip())
-
-    for m in markets:
-        result_text = get_result_by_date(today_str, m)
-        if result_text:
-            market_results[m] = result_text
-
-    if not market_results:
+    if not await run_db(get_recorded_markets, today_str):
         await update.callback_query.message.reply_text("⚠️ 今日尚未记录任何 market 的中奖号码。")
         return
 
-    winnings = []
-    for bet in bets:
-        number = bet["number"]
-        bet_type = bet["bet_type"]
-        market = bet["market"]
-        amount = bet["amount"]
-
-        if market not in market_results:
-            continue
-
-        result_text = market_results[market]
-        prize_lines = result_text.splitlines()
-        prizes = {"1st": [], "2nd": [], "3rd": [], "special": [], "consolation": []}
-
-        for line in prize_lines:
-            if ":" not in line:
-                continue
-            key, val = line.split(":", 1)
-            key = key.strip().lower()
-            val = val.strip()
-            if key in prizes:
-                if key in ["1st", "2nd", "3rd"]:
-                    prizes[key].append(val)
-                else:
-                    prizes[key] = val.split()
-
-        matched = None
-        for prize_type in ["1st", "2nd", "3rd", "special", "consolation"]:
-            if number in prizes[prize_type]:
-                matched = prize_type
-                break
-
-        if matched and bet_type in STANDARD_ODDS.get(market, {}):
-            payout = round(STANDARD_ODDS[market][bet_type] * amount, 2)
-            winnings.append(f"✅ {number} 中 {matched.upper()}，赢得 RM{payout:.2f}")
+    # 开奖录入时已结算好所有群，这里读取本群的中奖注单，每注一行显示所中奖项和合计派彩
+    winnings = [
+        f"✅ {w['market']} {w['number']} {w['bet_type']} 中 {'、'.join(p.upper() for p in w['prizes'])}，赢得 RM{w['total']:.2f}"
+        for w in await run_db(get_group_winning_bets, group_id, today_str)
+    ]
 
     # ✅ 把这段统一判断放在循环之后！
     if winnings:
@@ -230,7 +176,7 @@ async def handle_task_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
     elif data == "task:commission":
         today = datetime.now().date()
         start_date = today - timedelta(days=6)
-        rows = get_commission_summary(start_date, today, group_id)
+        rows = await run_db(get_commission_summary, start_date, today, group_id)
 
         if not rows:
             await query.message.reply_text("⚠️ 没有找到最近7天的佣金记录。")
@@ -264,7 +210,7 @@ async def handle_task_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
     elif data.startswith("delete_code:"):
         code = data.split(":", 1)[1]
         # 3. 调用新方法，一次性删除该 code 下的所有下注
-        deleted_count = delete_bets_by_code(code, group_id)
+        deleted_count = await run_db(delete_bets_by_code, code, group_id)
         if deleted_count > 0:
             await query.edit_message_text(f"✅ 已删除 Code:{code} 下的所有 {deleted_count} 注单。")
         else:
@@ -295,21 +241,23 @@ async def handle_task_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
 async def show_delete_code_page(query, context, group_id):
-    # ✅ 获取未被锁注的 code（内部已判断 19:00 锁注）
-    all_codes = get_recent_bet_codes(group_id=group_id)  # 只会返回未锁定的
-
-    if not all_codes:
-        await query.message.edit_text("⚠️ 没有可显示的下注 Code。")
-        return
-
-    # ✅ 不再需要去重，get_recent_bet_codes 已确保唯一且未锁定
-    total_codes = len(all_codes)
-
-    # 分页设置
+    # 分页设置：每一页的起始游标存成一个栈，delete_cursors[i] 为第 i 页的起点
     PAGE_SIZE = 5
     page = context.user_data.get("delete_page", 0)
-    offset = page * PAGE_SIZE
-    current_codes = all_codes[offset: offset + PAGE_SIZE]
+    cursors = context.user_data.get("delete_cursors") or [None]
+    if page == 0 or page >= len(cursors):
+        # 重新打开列表（或游标已失效）时从第一页开始
+        page, cursors = 0, [None]
+
+    # ✅ 一次索引查询取一页未锁注的 code（19:00 锁注条件在 SQL 里判断）
+    current_codes, next_cursor = await run_db(
+        get_bet_code_page, group_id, cursors[page], PAGE_SIZE
+    )
+    del cursors[page + 1:]
+    if next_cursor is not None:
+        cursors.append(next_cursor)
+    context.user_data["delete_page"] = page
+    context.user_data["delete_cursors"] = cursors
 
     if not current_codes:
         await query.message.edit_text("⚠️ 没有可显示的下注 Code。")
@@ -325,7 +273,7 @@ async def show_delete_code_page(query, context, group_id):
     buttons = []
     if page > 0:
         buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"delete_page:{page-1}"))
-    if offset + PAGE_SIZE < total_codes:
+    if next_cursor is not None:
         buttons.append(InlineKeyboardButton("➡️ 下一页", callback_data=f"delete_page:{page+1}"))
     if buttons:
         keyboard.append(buttons)
@@ -333,49 +281,20 @@ async def show_delete_code_page(query, context, group_id):
     # 发送消息
     await query.message.edit_text(
         f"🗑️ 请选择要删除的下注 Code：\n\n"
-        f"✅ 正在显示第 {page + 1} 页 / 共 {(total_codes + PAGE_SIZE - 1) // PAGE_SIZE} 页",
+        f"✅ 正在显示第 {page + 1} 页",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
-def get_bet_count_for_code(code, group_id):
-    conn = get_conn()
-    c = conn.cursor()
-    try:
-        if USE_PG:
-            c.execute(
-                "SELECT COUNT(*) FROM bets WHERE code=%s AND group_id=%s",
-                (code, group_id)
-            )
-        else:
-            c.execute(
-                "SELECT COUNT(*) FROM bets WHERE code=? AND group_id=?",
-                (code, group_id)
-            )
-        return c.fetchone()[0]
-    except Exception as e:
-        logger.error(f"❌ 获取下注数量失败: {e}")
-        return 0
-    finally:
-        conn.close()
-
 def delete_bets_by_code(code, group_id):
-    conn = get_conn()
-    c = conn.cursor()
     try:
         # 查询下注日期
-        if USE_PG:
-            c.execute("SELECT bet_date FROM bets WHERE code=%s AND group_id=%s", (code, group_id))
-        else:
-            c.execute("SELECT bet_date FROM bets WHERE code=? AND group_id=?", (code, group_id))
-
-        row = c.fetchone()
-        if not row:
+        bet_datetime = get_code_bet_date(code, group_id)
+        if not bet_datetime:
             return 0
 
         from datetime import datetime, time
         import pytz
 
-        bet_datetime = row[0]
         if isinstance(bet_datetime, str):
             bet_datetime = datetime.fromisoformat(bet_datetime)
 
@@ -394,21 +313,12 @@ def delete_bets_by_code(code, group_id):
             logger.warning("🔒 尝试删除已锁注的下注单，拒绝删除。")
             return 0
 
-        # 正常删除
-        if USE_PG:
-            c.execute("DELETE FROM bets WHERE code=%s AND group_id=%s", (code, group_id))
-        else:
-            c.execute("DELETE FROM bets WHERE code=? AND group_id=?", (code, group_id))
-
-        deleted = c.rowcount
-        conn.commit()
-        return deleted
+        # 正常删除（同一事务内扣减每日佣金汇总）
+        return delete_bet_and_commission(code, group_id)
 
     except Exception as e:
         logger.error(f"❌ 删除下注失败: {e}")
         return 0
-    finally:
-        conn.close()
 
 async def show_history_date_buttons(query, context, group_id):
     today = datetime.now().date()
@@ -441,7 +351,7 @@ async def show_history_date_buttons(query, context, group_id):
 
 async def show_bets_by_day(query, context, group_id, selected_date):
     date_obj = datetime.strptime(selected_date, "%Y-%m-%d").date()
-    bets = get_bet_history(date_obj, date_obj, group_id)
+    bets = await run_db(get_bet_history, date_obj, date_obj, group_id)
 
     if not bets:
         await query.edit_message_text("⚠️ 你在该日没有下注记录。")
@@ -497,56 +407,58 @@ async def handle_bet_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     text = update.message.text
     try:
-        bets = parse_bet_text(text)
+        # 解析 + 计价（相同注单重发时直接命中缓存）
+        bets, summary, unparsed = price_slip(text)
     except ValueError as e:
         await update.message.reply_text(f"❌ 格式错误：{e}")
         return
 
-    # 计算汇总和内嵌写回每笔
-    summary = calculate(bets)
     total = summary['total_amount']
     potential = summary['total_potential']
     commission = summary['total_commission']
 
-    # 缓存待确认注单
-    context.user_data['pending_bets'] = bets
+    # 保存待确认注单（按 群 / 注单消息 / 用户；多进程部署时存共享表）
+    slip_id = update.message.message_id
+    try:
+        await run_db(put_pending, update.message.chat.id, slip_id, update.message.from_user.id, bets)
+    except PendingSlipTooLarge as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
 
-    # 发送确认按钮
-    keyboard = [[InlineKeyboardButton("✅ 确认下注", callback_data="confirm_bet")]]
+    # 发送确认按钮（callback 带上注单消息 id）
+    keyboard = [[InlineKeyboardButton("✅ 确认下注", callback_data=f"confirm_bet:{slip_id}")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
+    # 提示无法识别的内容（最多列出 5 个）
+    warning = ""
+    if unparsed:
+        warning = "⚠️ 以下内容无法识别，已忽略：\n" + "\n".join(
+            f"第{line}行第{col}列：{tok}" for line, col, tok in unparsed[:5]
+        ) + "\n\n"
+    # 提示会超过赔付上限的号码（确认时还会在事务内再检查一次）
+    over = await run_db(check_exposure, bets)
+    if over:
+        warning += "⚠️ 以下号码将超过赔付上限，确认时会被拒绝：\n" + _format_exposure(over) + "\n\n"
+
     await update.message.reply_text(
+        f"{warning}"
         f"总额 RM{total:.2f}，最多可赢 RM{potential:.2f}\n"
         f"代理佣金 RM{commission:.2f}，确认下注吗？", reply_markup=reply_markup
     )
 
+def _format_exposure(over, limit=5):
+    """[(日期, 市场, 号码, 类型, 赔付)] → 提示文本（最多列出 limit 个）"""
+    return "\n".join(
+        f"{bet_date} {market} {number} {bet_type}：RM{liability:.2f}"
+        for bet_date, market, number, bet_type, liability in over[:limit]
+    )
+
 async def check_duplicate_numbers(update: Update, context: ContextTypes.DEFAULT_TYPE, group_id: int):
-    conn = get_conn()
-    c = conn.cursor()
     try:
         # 获取马来西亚当前日期
         tz = pytz.timezone("Asia/Kuala_Lumpur")
         today = datetime.now(tz).date()
 
-        if USE_PG:
-            c.execute("""
-                SELECT bet_date, number, market, bet_type,COUNT(*)
-                FROM bets
-                WHERE group_id = %s AND bet_date = %s
-                GROUP BY bet_date, number, market, bet_type
-                HAVING COUNT(*) > 1
-                ORDER BY bet_date DESC
-            """, (group_id, today))
-        else:
-            c.execute("""
-                SELECT bet_date, number, market, bet_type,COUNT(*)
-                FROM bets
-                WHERE group_id = ? AND bet_date = ?
-                GROUP BY bet_date, number, market, bet_type
-                HAVING COUNT(*) > 1
-                ORDER BY bet_date DESC
-            """, (group_id, today))
-
-        rows = c.fetchall()
+        rows = await run_db(get_duplicate_bets, group_id, today)
         if not rows:
             await update.callback_query.answer("✅ 没有发现重复下注号码", show_alert=True)
         else:
@@ -559,8 +471,6 @@ async def check_duplicate_numbers(update: Update, context: ContextTypes.DEFAULT_
     except Exception as e:
         logger.error(f"❌ 检查重复号码出错: {e}")
         await update.callback_query.answer("❌ 检查失败，请稍后再试", show_alert=True)
-    finally:
-        conn.close()
 
 async def handle_confirm_bet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -568,8 +478,14 @@ async def handle_confirm_bet(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # 1. 给用户一个点击反馈（短暂吐司）
     await query.answer(text="下注处理中…", show_alert=False)
 
-    # 2. 从缓存读取待确认注单
-    bets = context.user_data.get('pending_bets')
+    # 2. 取出待确认注单（取出即删除，重复点击只有一次能拿到）
+    group_id = query.message.chat.id
+    try:
+        slip_id = int(query.data.split(":", 1)[1])
+    except (IndexError, ValueError):
+        slip_id = None
+    pending_key = (group_id, slip_id, query.from_user.id)
+    bets = await run_db(take_pending, *pending_key) if slip_id is not None else None
     if not bets:
         # 如果找不到，给一个弹窗提示
         await query.answer(
@@ -582,8 +498,8 @@ async def handle_confirm_bet(update: Update, context: ContextTypes.DEFAULT_TYPE)
     now = datetime.now(tz)
     today = now.date()
 
-    # 提取下注的日期（格式为 DD/MM）
-    bet_date = datetime.strptime(bets[0]["date"], "%Y-%m-%d").date()
+    # 提取下注的日期（一条消息可有多个日期区块，按最早的日期判断锁注）
+    bet_date = datetime.strptime(min(b["date"] for b in bets), "%Y-%m-%d").date()
     lock_time = datetime.combine(bet_date, time(19, 0)).replace(tzinfo=tz)
 
     if now >= lock_time:
@@ -597,57 +513,28 @@ async def handle_confirm_bet(update: Update, context: ContextTypes.DEFAULT_TYPE)
     date_str = datetime.now().strftime('%y%m%d')
     rand_letters = ''.join(random.choices(string.ascii_uppercase, k=3))
     delete_code = f"{date_str}{rand_letters}"
-    group_id = query.message.chat.id
 
-    # 4. 写入数据库
-    # 1. 把 USE_PG 和 sql 定义提到函数最开头（或者模块顶层就定义一次）
+    # 4. 写入数据库（在线程池中执行，不阻塞其它群）
     try:
-        conn = get_conn()
-        cursor = conn.cursor()
-        if USE_PG:
-            sql = (
-                "INSERT INTO bets "
-                "(agent_id, group_id, bet_date, market, number, bet_type, mode, amount, potential_win, commission, code) "
-                "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
-            )
-        else:
-            sql = (
-                "INSERT INTO bets "
-                "(agent_id, group_id, bet_date, market, number, bet_type, mode, amount, potential_win, commission, code) "
-                "VALUES (?,?,?,?,?,?,?,?,?,?,?)"
-            )
-
-        for bet in bets:
-            # 把 market 列表统一转成字符串
-            market_str = ','.join(str(m) for m in bet['markets'])
-            params = (
-                query.from_user.id,
-                group_id,
-                bet['date'],
-                market_str,                  # 这里用 market_str
-                bet['number'],
-                bet['type'],
-                bet.get('mode') or '',       # 如果 mode 可能为 None，给个默认
-                bet['amount'],
-                bet['potential_win'],
-                bet['commission'],
-                delete_code
-            )
-                # 真正执行
-            cursor.execute(sql, params)
-        # 3. 循环外 commit
-        conn.commit()
+        await run_db(insert_bets, bets, query.from_user.id, group_id, delete_code)
 
+    except ExposureLimitExceeded as e:
+        # 号码赔付超过上限，整张注单未写入
+        await query.answer(
+            text="⛔️ 以下号码超过赔付上限，下注未成功：\n" + _format_exposure(e.over),
+            show_alert=True
+        )
+        return
     except Exception as e:
         logger.error(f"❌ 确认下注写库出错：{e}")
+        # 放回待确认注单，用户可以再点一次
+        await run_db(put_pending, *pending_key, bets)
         # 给用户明确的失败提示
         await query.answer(
             text="⚠️ 系统错误，下注失败，请稍后重试",
             show_alert=True
         )
         return
-    finally:
-        conn.close()
 
 # 4. 成功后继续下面的 edit_message_reply_markup + reply_text...
 
@@ -661,29 +548,92 @@ async def handle_confirm_bet(update: Update, context: ContextTypes.DEFAULT_TYPE)
         f"Code：{delete_code}\n"
     )
 
-    # 7. 清空缓存
-    context.user_data.pop('pending_bets', None)
-
-def main():
-
-    token = os.getenv('BOT_TOKEN')
-    if not token:
-        logger.error('BOT_TOKEN 未设置')
-        return
-    app = ApplicationBuilder().token(token).build()
+async def _on_shutdown(app):
+    # 归还并关闭连接池中的所有连接
+    logger.info(f"连接池统计：{pool_stats()}")
+    logger.info(f"注单缓存统计：{slip_cache_stats()}")
+    logger.info(f"待确认注单统计：{pending_stats()}")
+    logger.info(f"开奖成绩缓存统计：{results_cache_stats()}")
+    logger.info(f"更新处理统计：{app.update_processor.stats()}")
+    shutdown_executor()
+    close_pool()
+
+# ✅ 运行模式：BOT_MODE=polling（默认，长轮询）或 webhook（本地 HTTP 服务接收 Telegram 推送）
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")         # Telegram 访问的公网地址（含路径），webhook 模式必填
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")   # 校验请求头 X-Telegram-Bot-Api-Secret-Token
+
+def build_app(token, base_url=None, updater=True):
+    """
+    创建 Application 并注册所有 handler；base_url 可指向测试用的假 Bot API。
+    updater=False 时不自己接收更新，由外部放进 app.update_queue（supervisor 的 worker）
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        # 并发处理更新，同一个群内按顺序：慢群不阻塞其它群，注单与确认不乱序
+        .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_shutdown(_on_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
 
     # Handlers
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND) & filters.ChatType.PRIVATE,handle_result_input))
     app.add_handler( MessageHandler( filters.TEXT & ~filters.Regex(r'^/'), handle_bet_text)) 
-    app.add_handler(CallbackQueryHandler(handle_confirm_bet, pattern="^confirm_bet$"))
+    app.add_handler(CallbackQueryHandler(handle_confirm_bet, pattern="^confirm_bet(:|$)"))
     app.add_handler(CallbackQueryHandler(handle_task_buttons, pattern="^task:|^history_day:|^delete_code:|^confirm_delete:|^commission:|^delete_page:"))
     app.add_handler(CommandHandler("task", handle_task_menu))
     app.add_handler(CommandHandler("start", show_personal_menu))
     app.add_handler(CallbackQueryHandler(handle_personal_menu))
     app.add_handler(CallbackQueryHandler(handle_personal_menu, pattern="^input_result$"))
     app.add_handler(CallbackQueryHandler(handle_personal_menu, pattern="^result_market:"))
-    
-    app.run_polling()
+    return app
+
+def webhook_options():
+    """run_webhook / updater.start_webhook 的参数（main 和 fake_telegram 共用）"""
+    return {
+        "listen": WEBHOOK_LISTEN,
+        "port": WEBHOOK_PORT,
+        "url_path": WEBHOOK_PATH,
+        "webhook_url": WEBHOOK_URL,
+        "secret_token": WEBHOOK_SECRET,
+        "allowed_updates": Update.ALL_TYPES,
+    }
+
+def webhook_config_error():
+    """webhook 模式缺少的必填配置，返回错误信息（齐全时返回 None；main 和 supervisor 共用）"""
+    if not WEBHOOK_URL:
+        # 不填的话 PTB 会按监听地址（如 0.0.0.0）拼出 Telegram 访问不到的地址去 setWebhook
+        return "webhook 模式必须设置 WEBHOOK_URL（Telegram 访问的公网地址）"
+    if not WEBHOOK_SECRET:
+        return "webhook 模式必须设置 WEBHOOK_SECRET"
+    return None
+
+def main():
+
+    token = os.getenv('BOT_TOKEN')
+    if not token:
+        logger.error('BOT_TOKEN 未设置')
+        return
+    app = build_app(token)
+
+    if BOT_MODE == "webhook":
+        error = webhook_config_error()
+        if error:
+            logger.error(error)
+            return
+        # 收到 SIGINT / SIGTERM 时停止接收、处理完已收到的更新，再执行 _on_shutdown
+        logger.info(f"webhook 模式：监听 {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        app.run_webhook(**webhook_options())
+    else:
+        app.run_polling()
 
 if __name__ == '__main__':
     main()
@@ -1,62 +1,972 @@
+import hashlib
 import os
+import queue
+import re
+import textwrap
 import psycopg2
 import sqlite3
 import logging
+import threading
+import time as _time
+import weakref
 import pytz
-from datetime import date, timedelta, datetime,time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import execute_values
+from collections import OrderedDict
+from engine import PRIZE_RATIOS, bet_exposure, build_payout_table, perm_key, prize_payout
+from parser import MARKET_BITS, PRIZE_TIERS, market_mask, markets_from_mask, parse_result_text
+from datetime import timedelta, datetime
 
 logger = logging.getLogger(__name__)
 
 USE_PG = bool(os.getenv("DATABASE_URL"))
 
-def get_result_by_date(bet_date, market):
-    print(f"查询开奖：日期={bet_date}，market={market}")
+def _sql(query):
+    """SQL 统一用 %s 书写；SQLite 下换成 ? 占位符（拼接生成的临时 SQL 用，固定 SQL 请注册为具名查询）"""
+    return query if USE_PG else query.replace("%s", "?")
+
+# ✅ 具名查询注册表：每条固定 SQL 只写一份（%s 占位、两边都支持的语法），
+#   按后端编译一次并缓存；Postgres 下每条借出的连接上 PREPARE 一次，之后只发 EXECUTE，
+#   省掉每次的解析和规划。调用方统一 run_query(cursor, 名称, 参数)，不再区分后端
+DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "1") == "1"
+
+QUERIES = {}
+_compiled = {}
+_prepared = weakref.WeakKeyDictionary()   # psycopg2 连接 → 该连接上已 PREPARE 的查询名（连接被回收即清掉）
+
+# 只有一种后端支持的写法，注册时直接拒绝
+_DIALECT_ONLY = re.compile(r"DISTINCT\s+ON|TO_CHAR|strftime|last_insert_rowid|::|\?|ILIKE", re.I)
+
+def register_query(name, sql):
+    """注册一条具名查询，返回名称（作模块常量用）"""
+    sql = textwrap.dedent(sql).strip()
+    if name in QUERIES:
+        raise ValueError(f"查询重名：{name}")
+    if _DIALECT_ONLY.search(sql):
+        raise ValueError(f"查询 {name} 使用了只有一种后端支持的语法")
+    QUERIES[name] = sql
+    return name
+
+def compile_query(name, backend=None):
+    """
+    把具名查询编译成某个后端的 SQL（结果缓存）：
+      "sqlite"：? 占位；"pg"：%s 占位；"pg_prepared"：$1..$n，供 PREPARE 使用
+    """
+    backend = backend or ("pg" if USE_PG else "sqlite")
+    key = (name, backend)
+    if key not in _compiled:
+        sql = QUERIES[name]
+        if backend == "sqlite":
+            sql = sql.replace("%s", "?")
+        elif backend == "pg_prepared":
+            counter = iter(range(1, sql.count("%s") + 1))
+            sql = re.sub("%s", lambda _: f"${next(counter)}", sql)
+        _compiled[key] = sql
+    return _compiled[key]
+
+def run_query(cursor, name, params=(), many=False):
+    """在 cursor 上执行具名查询（many=True 时 params 为多组参数），返回 cursor"""
+    if USE_PG and DB_PREPARED_STATEMENTS:
+        prepared = _prepared.setdefault(cursor.connection, set())
+        if name not in prepared:
+            cursor.execute(f"PREPARE {name} AS {compile_query(name, 'pg_prepared')}")
+            prepared.add(name)
+        n = QUERIES[name].count("%s")
+        sql = f"EXECUTE {name} ({', '.join(['%s'] * n)})" if n else f"EXECUTE {name}"
+    else:
+        sql = compile_query(name)
+    if many:
+        cursor.executemany(sql, params)
+    elif params:
+        cursor.execute(sql, params)
+    else:
+        cursor.execute(sql)
+    return cursor
+
+def check_queries():
+    """
+    检查所有具名查询两种后端的一致性，返回问题列表（空列表表示全部通过）：
+      - 两种后端编译后的占位符个数一致
+      - 在当前后端的实际表结构上能通过编译（SQLite: EXPLAIN；Postgres: PREPARE）
+    """
+    problems = []
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT result_text FROM results WHERE bet_date = %s AND market = %s", (bet_date, market))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else None
+    try:
+        c = conn.cursor()
+        for name, sql in sorted(QUERIES.items()):
+            n = sql.count("%s")
+            sqlite_sql = compile_query(name, "sqlite")
+            pg_sql = compile_query(name, "pg_prepared")
+            if sqlite_sql.count("?") != n or f"${n}" not in pg_sql and n:
+                problems.append(f"{name}：占位符个数不一致")
+                continue
+            try:
+                if USE_PG:
+                    c.execute(f"PREPARE check_{name} AS {pg_sql}")
+                    c.execute(f"DEALLOCATE check_{name}")
+                else:
+                    c.execute(f"EXPLAIN {sqlite_sql}", (None,) * n)
+                    c.fetchall()
+            except Exception as e:
+                problems.append(f"{name}：{e}")
+    finally:
+        conn.close()
+    return problems
 
-def save_result_to_db(bet_date, market, result_text):
+# ✅ 开奖成绩缓存：开奖后几百个群同时点「查看中奖」，都从内存读取
+#   - 按 (日期, market) 缓存 result_text；未命中时一条查询载入当天全部市场
+#   - 尚未开奖的市场记为 None，只缓存 RESULTS_CACHE_NEGATIVE_TTL 秒（可能由其它进程录入）
+#   - save_result_to_db 提交后直接写入缓存；超过 RESULTS_CACHE_DAYS 天的旧开奖被淘汰
+RESULTS_CACHE_DAYS = int(os.getenv("RESULTS_CACHE_DAYS", "7"))
+RESULTS_CACHE_NEGATIVE_TTL = float(os.getenv("RESULTS_CACHE_NEGATIVE_TTL", "30"))
+RESULTS_CACHE_STATS = {"hits": 0, "misses": 0, "loads": 0, "evictions": 0}
+
+_results_cache = {}
+_results_cache_lock = threading.Lock()
+
+def _cache_results(bet_date, results):
+    """results: {market: result_text or None}；调用方需持有 _results_cache_lock"""
+    now = _time.monotonic()
+    for market, result_text in results.items():
+        _results_cache[(str(bet_date), market)] = (result_text, now)
+
+    # 淘汰过旧的开奖
+    cutoff = (datetime.now().date() - timedelta(days=RESULTS_CACHE_DAYS)).isoformat()
+    for key in [k for k in _results_cache if k[0] < cutoff]:
+        del _results_cache[key]
+        RESULTS_CACHE_STATS["evictions"] += 1
+
+def _cached_result(key):
+    """返回 (命中?, result_text)；调用方需持有 _results_cache_lock"""
+    entry = _results_cache.get(key)
+    if entry is None:
+        return False, None
+    result_text, stored_at = entry
+    if result_text is None and _time.monotonic() - stored_at > RESULTS_CACHE_NEGATIVE_TTL:
+        return False, None
+    return True, result_text
+
+_Q_RESULTS_FOR_DATE = register_query("results_for_date", """
+    SELECT market, result_text FROM results WHERE bet_date = %s
+""")
+
+def _load_results(bet_date):
+    """一条查询载入某日全部市场的成绩并写入缓存"""
     conn = get_conn()
-    cur = conn.cursor()
+    try:
+        rows = run_query(conn.cursor(), _Q_RESULTS_FOR_DATE, (str(bet_date),)).fetchall()
+    finally:
+        conn.close()
+    results = dict.fromkeys(MARKET_BITS)
+    results.update(rows)
+    with _results_cache_lock:
+        RESULTS_CACHE_STATS["loads"] += 1
+        _cache_results(bet_date, results)
+    return results
 
-    # ✅ 创建表（只执行一次，无需重复执行）
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS results (
-            bet_date TEXT,
-            market TEXT,
-            result_text TEXT,
-            PRIMARY KEY (bet_date, market)
-        )
-    """)
+def get_result_by_date(bet_date, market):
+    """某日某市场的开奖成绩文本，尚未开奖返回 None（经缓存）"""
+    with _results_cache_lock:
+        hit, result_text = _cached_result((str(bet_date), market))
+        RESULTS_CACHE_STATS["hits" if hit else "misses"] += 1
+    if hit:
+        return result_text
+    return _load_results(bet_date).get(market)
+
+def get_results_for_date(bet_date):
+    """某日已开奖的 {market: result_text}（经缓存）"""
+    with _results_cache_lock:
+        cached = [_cached_result((str(bet_date), m)) for m in MARKET_BITS]
+        hit = all(h for h, _ in cached)
+        RESULTS_CACHE_STATS["hits" if hit else "misses"] += 1
+    if hit:
+        results = dict(zip(MARKET_BITS, (text for _, text in cached)))
+    else:
+        results = _load_results(bet_date)
+    return {m: text for m, text in results.items() if text is not None}
+
+def results_cache_stats():
+    """返回开奖成绩缓存计数器快照（含当前条数）"""
+    with _results_cache_lock:
+        return dict(RESULTS_CACHE_STATS, size=len(_results_cache))
+
+def _draw_rows(bet_date, market, draw):
+    """{"1st": ["1234"], "special": [...]} → draw_numbers 表的行"""
+    return [
+        (bet_date, market, tier, position, number, perm_key(number))
+        for tier in PRIZE_TIERS
+        for position, number in enumerate(draw.get(tier, []), start=1)
+    ]
+
+_Q_RESULT_UPSERT = register_query("result_upsert", """
+    INSERT INTO results (bet_date, market, result_text)
+    VALUES (%s, %s, %s)
+    ON CONFLICT(bet_date, market) DO UPDATE SET result_text = excluded.result_text
+""")
+_Q_DRAW_NUMBERS_DELETE = register_query("draw_numbers_delete", """
+    DELETE FROM draw_numbers WHERE bet_date = %s AND market = %s
+""")
+_Q_DRAW_NUMBERS_INSERT = register_query("draw_numbers_insert", """
+    INSERT INTO draw_numbers (bet_date, market, prize, position, number, perm_key)
+    VALUES (%s, %s, %s, %s, %s, %s)
+""")
+_Q_DRAW_NUMBERS_FOR_DRAW = register_query("draw_numbers_for_draw", """
+    SELECT prize, number FROM draw_numbers WHERE bet_date = %s AND market = %s
+""")
+
+def save_result_to_db(bet_date, market, result_text, draw=None):
+    """
+    保存某日某市场的开奖成绩。
+
+    result_text 原样存入 results 表用于显示；同时拆成每个中奖号码一行写入
+    draw_numbers（奖级 + 名次），并在同一事务内结算所有群的注单
+    （分片模式下成绩提交后再逐个分片结算，没结算完的分片由 settle_pending_shards 补上）。
+    draw 为已解析好的 parse_result_text 结果，不传则从 result_text 解析。
+    """
+    if draw is None:
+        draw = parse_result_text(result_text)
+
+    with transaction() as conn:
+        cur = conn.cursor()
+
+        # ✅ 插入或更新数据
+        run_query(cur, _Q_RESULT_UPSERT, (bet_date, market, result_text))
+
+        # 重新录入（更正成绩）时整体替换
+        run_query(cur, _Q_DRAW_NUMBERS_DELETE, (bet_date, market))
+        run_query(cur, _Q_DRAW_NUMBERS_INSERT, _draw_rows(bet_date, market, draw), many=True)
+
+        # 同一事务内结算所有群在这一期的注单
+        if not SHARDED:
+            _record_settled_draw(cur, bet_date, market, _settle_draw(cur, bet_date, market))
+
+    if SHARDED:
+        settle_draw(bet_date, market)
+
+    # 提交后再写入成绩缓存；旧的派彩向量作废，下次查询时再从 draw_numbers 构建
+    with _results_cache_lock:
+        _cache_results(bet_date, {market: result_text})
+    with _payout_cache_lock:
+        _payout_cache.pop((str(bet_date), market), None)
+
+# ✅ 派彩向量缓存：每期开奖 (bet_date, market) 只构建一次，按最近使用淘汰
+DRAW_PAYOUT_CACHE_SIZE = int(os.getenv("DRAW_PAYOUT_CACHE_SIZE", "64"))
+_payout_cache = OrderedDict()
+_payout_cache_lock = threading.Lock()
+
+def _cache_payout_table(bet_date, market, table):
+    with _payout_cache_lock:
+        _payout_cache[(str(bet_date), market)] = table
+        _payout_cache.move_to_end((str(bet_date), market))
+        while len(_payout_cache) > DRAW_PAYOUT_CACHE_SIZE:
+            _payout_cache.popitem(last=False)
+
+def get_draw_payouts(bet_date, market):
+    """
+    某期开奖的派彩向量（engine.build_payout_table），从 draw_numbers 构建并缓存。
+    尚未开奖返回 None。
+    """
+    key = (str(bet_date), market)
+    with _payout_cache_lock:
+        if key in _payout_cache:
+            _payout_cache.move_to_end(key)
+            return _payout_cache[key]
+
+    conn = get_conn()
+    try:
+        rows = run_query(conn.cursor(), _Q_DRAW_NUMBERS_FOR_DRAW, (str(bet_date), market)).fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return None
+
+    draw = {}
+    for prize, number in rows:
+        draw.setdefault(prize, []).append(number)
+    table = build_payout_table(market, draw)
+    _cache_payout_table(bet_date, market, table)
+    return table
+
+def draw_payout(bet_date, market, number, bet_type, mode, amount):
+    """单注在某期开奖的派彩（O(1) 查表），未开奖返回 0"""
+    table = get_draw_payouts(bet_date, market)
+    if table is None or bet_type not in table:
+        return 0.0
+    return round(table[bet_type][mode or ""][int(number)] * float(amount), 2)
+
+def get_recorded_markets(bet_date):
+    """
+    某日已开奖并结算的市场。成绩和结算在 save_result_to_db 的同一事务内写入，
+    有成绩即已结算，所以直接读成绩缓存。
+    """
+    return list(get_results_for_date(bet_date))
+
+def _settlement_sql(bet_date, group_id=None, market=None):
+    """
+    结算查询：开奖号码 join 注单，在数据库里一次算出某日全部中奖行。
+
+    从 draw_numbers（每个市场每天只有二十多行）出发，按 bets 的
+    (bet_date, number) / (bet_date, perm_key) 索引探测注单：
+      - 普通注单：号码完全一致
+      - box / ibox：perm_key 一致（任一排列）
+    再按 market_mask 过滤市场、按 PRIZE_RATIOS 过滤 B/S/A/C 可中的奖级。
+    返回 (sql, params)。
+    """
+    eligibility = " OR ".join(
+        f"(b.bet_type = '{bet_type}' AND d.prize IN ({', '.join(repr(p) for p in tiers)}))"
+        for bet_type, tiers in PRIZE_RATIOS.items()
+    )
+    where = "d.bet_date = %s"
+    filter_params = [bet_date]
+    if market is not None:
+        where += " AND d.market = %s"
+        filter_params.append(market)
+    if group_id is not None:
+        where += " AND b.group_id = %s"
+        filter_params.append(group_id)
+
+    parts = []
+    params = []
+    for match in (
+        "b.number = d.number AND COALESCE(b.mode, '') NOT IN ('box', 'ibox')",
+        "b.perm_key = d.perm_key AND b.mode IN ('box', 'ibox')",
+    ):
+        parts.append(f"""
+            SELECT b.id, b.group_id, b.number, b.bet_type, b.mode, b.amount,
+                   d.market, d.prize, d.position, d.number
+            FROM draw_numbers d
+            JOIN markets mk ON mk.code = d.market
+            JOIN bets b
+              ON b.bet_date = d.bet_date AND {match} AND (b.market_mask & mk.bit) <> 0
+            WHERE {where} AND ({eligibility})
+        """)
+        params += filter_params
+    return " UNION ALL ".join(parts) + " ORDER BY 1, 7, 8, 9", params
+
+# 结算查询按过滤条件（群 / 市场）注册四个变体，参数个数由条件决定
+_Q_SETTLEMENT = {
+    (by_group, by_market): register_query(
+        "settlement" + "_group" * by_group + "_market" * by_market,
+        _settlement_sql(None, by_group or None, by_market or None)[0],
+    )
+    for by_group in (False, True)
+    for by_market in (False, True)
+}
+
+SETTLEMENT_FIELDS = (
+    "bet_id", "group_id", "number", "bet_type", "mode", "amount",
+    "market", "prize", "position", "winning_number", "payout",
+)
+
+def _settle_rows(cursor, bet_date, group_id=None, market=None):
+    """在给定 cursor 上执行结算查询，返回中奖行（字段见 SETTLEMENT_FIELDS）"""
+    _, params = _settlement_sql(bet_date, group_id, market)
+    run_query(cursor, _Q_SETTLEMENT[group_id is not None, market is not None], params)
+    return [
+        (bet_id, gid, number, bet_type, mode or None, float(amount),
+         mkt, prize, position, win_no,
+         prize_payout(mkt, bet_type, mode, prize, amount, number))
+        for bet_id, gid, number, bet_type, mode, amount, mkt, prize, position, win_no
+        in cursor.fetchall()
+    ]
+
+def settle(bet_date, group_id=None, market=None):
+    """
+    结算某日的注单（可限定群 / 市场，不限定则为所有群）。
+
+    返回每个中奖 (注单, 市场, 奖项) 一行：
+      {"bet_id", "group_id", "number", "bet_type", "mode", "amount",
+       "market", "prize", "position", "winning_number", "payout"}
+    """
+    rows = []
+    for conn in _each_conn(group_id, join=True):
+        rows += _settle_rows(conn.cursor(), bet_date, group_id, market)
+    if group_id is None and SHARDED:
+        # 各分片的结果合并后按结算查询的 ORDER BY 重新排序
+        rows.sort(key=lambda r: (r[0], r[6], r[7], r[8]))
+    return [dict(zip(SETTLEMENT_FIELDS, r)) for r in rows]
+
+_Q_SETTLEMENTS_DELETE = register_query("settlements_delete", """
+    DELETE FROM settlements WHERE bet_date = %s AND market = %s
+""")
+_Q_SETTLEMENTS_INSERT = register_query("settlements_insert", f"""
+    INSERT INTO settlements (bet_date, {', '.join(SETTLEMENT_FIELDS)})
+    VALUES (%s, {', '.join(['%s'] * len(SETTLEMENT_FIELDS))})
+""")
+_Q_SETTLED_DRAW_UPSERT = register_query("settled_draw_upsert", """
+    INSERT INTO settled_draws (bet_date, market, winners, settled_at)
+    VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+    ON CONFLICT(bet_date, market) DO UPDATE
+    SET winners = excluded.winners, settled_at = excluded.settled_at
+""")
+_Q_GROUP_WINNINGS = register_query("group_winnings", f"""
+    SELECT {', '.join(SETTLEMENT_FIELDS)}
+    FROM settlements
+    WHERE group_id = %s AND bet_date = %s
+    ORDER BY bet_id, market, prize, position
+""")
+
+def _settle_draw(cursor, bet_date, market):
+    """
+    结算一期开奖（某日某市场）cursor 所在库里的所有群，结果写入 settlements，返回中奖行数。
+
+    先删后插，成绩更正后重新保存会得到同样的结果（幂等）。
+    """
+    rows = _settle_rows(cursor, bet_date, market=market)
+    run_query(cursor, _Q_SETTLEMENTS_DELETE, (bet_date, market))
+    if rows:
+        run_query(cursor, _Q_SETTLEMENTS_INSERT, [(bet_date,) + r for r in rows], many=True)
+    return len(rows)
+
+def _record_settled_draw(cursor, bet_date, market, winners):
+    run_query(cursor, _Q_SETTLED_DRAW_UPSERT, (bet_date, market, winners))
+    logger.info(f"结算完成：{bet_date} {market}，中奖 {winners} 行")
+
+def settle_draw(bet_date, market):
+    """重新结算一期开奖（分片模式下每个分片一个事务），返回中奖行数"""
+    if not SHARDED:
+        with transaction() as conn:
+            cur = conn.cursor()
+            winners = _settle_draw(cur, bet_date, market)
+            _record_settled_draw(cur, bet_date, market, winners)
+        return winners
+
+    winners = 0
+    for key in _shard_keys(join=True):
+        with _transaction(key) as conn:
+            cur = conn.cursor()
+            shard_winners = _settle_draw(cur, bet_date, market)
+            # 同一事务内记下该分片按哪一版成绩结算，中途失败的分片由 settle_pending_shards 补结算
+            run_query(cur, _Q_SHARD_SETTLED_UPSERT, (shard_winners, bet_date, market))
+            winners += shard_winners
+    with transaction() as conn:
+        _record_settled_draw(conn.cursor(), bet_date, market, winners)
+    return winners
+
+# 分片结算状态：每个分片的 shard_settled_draws 记录已按哪一版 result_text 结算
+_Q_SHARD_SETTLED_UPSERT = register_query("shard_settled_upsert", """
+    INSERT INTO shard_settled_draws (bet_date, market, result_text, winners, settled_at)
+    SELECT bet_date, market, result_text, %s, CURRENT_TIMESTAMP
+    FROM results
+    WHERE bet_date = %s AND market = %s
+    ON CONFLICT(bet_date, market) DO UPDATE
+    SET result_text = excluded.result_text, winners = excluded.winners, settled_at = excluded.settled_at
+""")
+_Q_SHARD_UNSETTLED = register_query("shard_unsettled", """
+    SELECT r.bet_date, r.market
+    FROM results r
+    LEFT JOIN shard_settled_draws s ON s.bet_date = r.bet_date AND s.market = r.market
+    WHERE s.bet_date IS NULL OR COALESCE(s.result_text, '') <> COALESCE(r.result_text, '')
+""")
+
+def settle_pending_shards():
+    """
+    分片模式：成绩已录入（或更正）、但还有分片没按当前成绩结算的开奖
+    （逐个分片结算时进程中途退出）重新结算，返回重新结算的 [(日期, 市场)]
+    """
+    if not SHARDED:
+        return []
+    pending = set()
+    for conn in _each_conn(join=True):
+        pending.update(run_query(conn.cursor(), _Q_SHARD_UNSETTLED).fetchall())
+    for bet_date, market in sorted(pending):
+        logger.warning(f"分片结算未完成，重新结算：{bet_date} {market}")
+        settle_draw(bet_date, market)
+    return sorted(pending)
+
+def get_group_winnings(group_id, bet_date):
+    """读取预先结算好的某群某日中奖行（字段同 settle）"""
+    conn = get_conn(group_id)
+    try:
+        c = run_query(conn.cursor(), _Q_GROUP_WINNINGS, (str(group_id), str(bet_date)))
+        return [dict(zip(SETTLEMENT_FIELDS, r)) for r in c.fetchall()]
+    finally:
+        conn.close()
+
+def get_group_winning_bets(group_id, bet_date):
+    """
+    某群某日按注单汇总的中奖：每个 (注单, 市场) 一项，带所中奖项列表 prizes，
+    合计派彩 total 用该期派彩向量 O(1) 查表（不用逐行相加）。
+    """
+    bets = OrderedDict()
+    for w in get_group_winnings(group_id, bet_date):
+        bet = bets.setdefault((w["bet_id"], w["market"]), dict(w, prizes=[]))
+        bet["prizes"].append(w["prize"])
+    for bet in bets.values():
+        bet["total"] = draw_payout(bet_date, bet["market"], bet["number"],
+                                   bet["bet_type"], bet["mode"], bet["amount"])
+    return list(bets.values())
+
+
+# ✅ 连接池配置（可通过环境变量调整）
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))         # 第一次借出时预先建立的连接数
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))       # 等待空闲连接的最长秒数
+DB_POOL_PING_IDLE = float(os.getenv("DB_POOL_PING_IDLE", "30"))   # 闲置超过该秒数，借出前先 SELECT 1 检查
+SQLITE_PATH = os.getenv("SQLITE_PATH", "data.db")
+
+# 连接池计数器：checkouts 借出次数 / waits 需要排队的次数 / reconnects 重建的坏连接数
+POOL_STATS = {"checkouts": 0, "waits": 0, "reconnects": 0, "in_use": 0}
+
+_pg_idle = []          # 空闲的 Postgres 连接，后进先出（最近用过的先借出）
+_pg_warmed = False
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_last_used = weakref.WeakKeyDictionary()   # 连接 → 最近一次归还的时间
+_sqlite_local = threading.local()
+
+
+class _PooledConnection:
+    """借出的连接：用法与原连接一致，但 close() 是归还连接池而不是断开"""
+
+    def __init__(self, raw, release):
+        self._raw = raw
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        if name in ("_raw", "_release"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._raw, name, value)
+
+    def __enter__(self):
+        self._raw.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._raw.__exit__(*exc)
 
-    # ✅ 插入或更新数据
-    cur.execute("""
-        INSERT INTO results (bet_date, market, result_text)
-        VALUES (%s, %s, %s)
-        ON CONFLICT(bet_date, market) DO UPDATE SET result_text = excluded.result_text
-    """, (bet_date, market, result_text))
+    def close(self):
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._release(raw)
 
-    conn.commit()
-    conn.close()
 
+def _pg_connect():
+    conn = psycopg2.connect(os.getenv("DATABASE_URL"))
+    conn.autocommit = True
+    _last_used[conn] = _time.monotonic()
+    return conn
 
-# ✅ 统一获取连接函数
-def get_conn():
+
+def _pg_discard(conn):
+    """断开一条连接，同时清掉它的预编译语句和最近使用时间"""
+    _last_used.pop(conn, None)
+    _prepared.pop(conn, None)
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+def _warm_pg():
+    # 第一次借出时预先建立 DB_POOL_MIN 条连接
+    global _pg_warmed
+    with _pool_lock:
+        if _pg_warmed:
+            return
+        _pg_warmed = True
+        need = DB_POOL_MIN - len(_pg_idle)
+    for _ in range(need):
+        conn = _pg_connect()
+        with _pool_lock:
+            _pg_idle.append(conn)
+
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    if _time.monotonic() - _last_used.get(conn, 0) < DB_POOL_PING_IDLE:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.fetchone()
+        cur.close()
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+
+
+def _checkout_pg():
+    # 先尝试不等待地拿一个名额，拿不到才计一次排队
+    if not _pool_slots.acquire(blocking=False):
+        with _pool_lock:
+            POOL_STATS["waits"] += 1
+        if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+            raise pg_pool.PoolError(f"连接池已满，等待 {DB_POOL_TIMEOUT}s 超时")
+
+    try:
+        _warm_pg()
+        while True:
+            with _pool_lock:
+                conn = _pg_idle.pop() if _pg_idle else None
+            if conn is None:
+                conn = _pg_connect()
+                break
+            if _is_healthy(conn):
+                break
+            # 数据库重启后旧连接会失效 → 丢弃，换下一条空闲连接或新建
+            with _pool_lock:
+                POOL_STATS["reconnects"] += 1
+            _pg_discard(conn)
+    except Exception:
+        _pool_slots.release()
+        raise
+
+    with _pool_lock:
+        POOL_STATS["checkouts"] += 1
+        POOL_STATS["in_use"] += 1
+    return _PooledConnection(conn, _release_pg)
+
+
+def _release_pg(conn):
+    try:
+        if not conn.closed and not conn.autocommit:
+            # 调用方没提交的事务一律回滚，避免脏状态被下一个人借走
+            try:
+                conn.rollback()
+                conn.autocommit = True
+            except psycopg2.Error:
+                _pg_discard(conn)
+        if conn.closed:
+            _pg_discard(conn)
+        else:
+            # 空闲连接全部保留（最多 DB_POOL_MAX 条，由借出名额限制），不断开重连
+            _last_used[conn] = _time.monotonic()
+            with _pool_lock:
+                _pg_idle.append(conn)
+    finally:
+        with _pool_lock:
+            POOL_STATS["in_use"] -= 1
+        _pool_slots.release()
+
+
+# ✅ SQLite 引擎：
+#   - 读：每个库文件一组只读连接（query_only，最多 DB_POOL_MAX 条），借出 / 归还，不再每个线程一条
+#   - 写：确认 / 删除 / 待确认注单这些高频写入交给该库文件唯一的写线程，
+#         写线程把队列里攒下的写操作放进同一个事务（每个操作一个 SAVEPOINT），整批提交一次；
+#         同一进程内不再有多个连接抢写锁，也就不会出现 database is locked
+#   - WAL：读不挡写、写不挡读；synchronous=NORMAL 下提交不等 fsync，只在 checkpoint 时落盘
+#   迁移、重建汇总、录入成绩等低频写入仍走 transaction()（本线程的可写连接，靠 busy_timeout 排队）
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))        # 负数为 KiB：64 MiB
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "10"))      # 等其它进程的写锁（秒）
+SQLITE_WRITER = os.getenv("SQLITE_WRITER", "1") == "1"                   # 0：在调用方线程里直接写（旧方式）
+SQLITE_WRITE_BATCH = int(os.getenv("SQLITE_WRITE_BATCH", "64"))          # 一次提交最多合并的写操作数
+
+# 写线程计数器：writes 写操作数 / batches 提交次数 / failed 失败的写操作 / max_batch 最大一批
+WRITER_STATS = {"writes": 0, "batches": 0, "failed": 0, "max_batch": 0}
+
+_sqlite_pools = {}     # 连接键 → 空闲只读连接
+_sqlite_slots = {}     # 连接键 → 只读连接名额
+_sqlite_writers = {}   # 连接键 → _SQLiteWriter
+
+
+def _open_sqlite(key, readonly=False):
+    path = SQLITE_PATH if key is None else shard_path(key[1])
+    conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+    schemas = ["main"]
+    if key is not None and key[0] == "join":
+        # 结算要 join 共享库的开奖号码：附加共享库，用临时视图盖住分片里同名的空表
+        conn.execute("ATTACH DATABASE ? AS shared", (SQLITE_PATH,))
+        for table in SHARED_TABLES:
+            conn.execute(f"CREATE TEMP VIEW {table} AS SELECT * FROM shared.{table}")
+        schemas.append("shared")
+    for schema in schemas:
+        if not readonly:
+            conn.execute(f"PRAGMA {schema}.journal_mode = {SQLITE_JOURNAL_MODE}")
+        conn.execute(f"PRAGMA {schema}.synchronous = {SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA {schema}.mmap_size = {SQLITE_MMAP_SIZE}")
+        conn.execute(f"PRAGMA {schema}.cache_size = {SQLITE_CACHE_SIZE}")
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+def _checkout_sqlite(key=None):
+    # 只读连接池：先不等待地拿名额，拿不到才计一次排队
+    with _pool_lock:
+        slots = _sqlite_slots.get(key)
+        if slots is None:
+            slots = _sqlite_slots[key] = threading.BoundedSemaphore(DB_POOL_MAX)
+            _sqlite_pools[key] = []
+    if not slots.acquire(blocking=False):
+        with _pool_lock:
+            POOL_STATS["waits"] += 1
+        if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+            raise TimeoutError(f"SQLite 只读连接已满，等待 {DB_POOL_TIMEOUT}s 超时")
+
+    with _pool_lock:
+        idle = _sqlite_pools[key]
+        conn = idle.pop() if idle else None
+        POOL_STATS["checkouts"] += 1
+        POOL_STATS["in_use"] += 1
+    if conn is None:
+        try:
+            conn = _open_sqlite(key, readonly=True)
+        except Exception:
+            with _pool_lock:
+                POOL_STATS["in_use"] -= 1
+            slots.release()
+            raise
+    return _PooledConnection(conn, lambda raw: _release_sqlite(key, raw))
+
+
+def _release_sqlite(key, conn):
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        with _pool_lock:
+            _sqlite_pools[key].append(conn)
+    finally:
+        with _pool_lock:
+            POOL_STATS["in_use"] -= 1
+        _sqlite_slots[key].release()
+
+
+def _sqlite_write_conn(key=None):
+    # transaction() 用的可写连接：每个线程对每个库文件保留一条
+    conns = getattr(_sqlite_local, "conns", None)
+    if conns is None:
+        conns = _sqlite_local.conns = {}
+    conn = conns.get(key)
+    if conn is None:
+        conn = conns[key] = _open_sqlite(key)
+    return _PooledConnection(conn, _release_sqlite_write)
+
+
+def _release_sqlite_write(conn):
+    if conn.in_transaction:
+        conn.rollback()
+
+
+class _SQLiteWriter:
+    """
+    一个库文件的写线程：调用方 submit(fn) 后阻塞，写线程一次取出队列里全部（最多
+    SQLITE_WRITE_BATCH 个）写操作，在同一个事务里依次执行 fn(cursor)，整批提交后
+    再把各自的返回值 / 异常交还调用方。每个操作包在 SAVEPOINT 里，出错只回滚它自己。
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name=f"sqlite-writer-{key}", daemon=True)
+        self.thread.start()
+
+    def submit(self, fn):
+        future = Future()
+        self.queue.put((fn, future))
+        return future.result()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        conn = _open_sqlite(self.key)
+        try:
+            running = True
+            while running:
+                batch = [self.queue.get()]
+                while len(batch) < SQLITE_WRITE_BATCH:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:
+                    running = False
+                    batch = [job for job in batch if job is not None]
+                if batch:
+                    self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit(self, conn, batch):
+        done = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, future in batch:
+                conn.execute("SAVEPOINT write")
+                try:
+                    result = fn(conn.cursor())
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    future.set_exception(e)
+                else:
+                    conn.execute("RELEASE write")
+                    done.append((future, result))
+            conn.commit()
+        except Exception as e:
+            # 整批提交失败：已执行成功的操作一起回滚，都报同一个错误
+            if conn.in_transaction:
+                conn.rollback()
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            with _pool_lock:
+                WRITER_STATS["failed"] += len(batch)
+            return
+
+        with _pool_lock:
+            WRITER_STATS["writes"] += len(batch)
+            WRITER_STATS["batches"] += 1
+            WRITER_STATS["failed"] += len(batch) - len(done)
+            WRITER_STATS["max_batch"] = max(WRITER_STATS["max_batch"], len(batch))
+        for future, result in done:
+            future.set_result(result)
+
+
+def _write(key, fn):
+    """
+    执行一次写操作 fn(cursor)，返回 fn 的返回值；fn 抛出的异常原样抛出，它的改动全部回滚。
+    SQLite 下交给该库文件的写线程（与其它写操作合并提交），Postgres 下在本线程的事务里执行
+    """
+    if USE_PG or not SQLITE_WRITER:
+        with _transaction(key) as conn:
+            return fn(conn.cursor())
+    writer = _sqlite_writers.get(key)
+    if writer is None:
+        with _pool_lock:
+            writer = _sqlite_writers.get(key)
+            if writer is None:
+                writer = _sqlite_writers[key] = _SQLiteWriter(key)
+    return writer.submit(fn)
+
+
+# ✅ SQLite 分片（SQLITE_SHARDS > 0，仅 SQLite 下生效）：按 group_id 哈希把各群的注单、
+#    汇总、赔付、待确认注单分到 SQLITE_SHARDS 个文件（data.shard0.db …），每个分片各自一把写锁，
+#    不同群的确认下注可以并行写入；开奖成绩（SHARED_TABLES）只在 SQLITE_PATH 保留一份。
+#    不限群的查询（结算所有群、全部 code）逐个分片查询再合并；赔付上限要跨分片加锁，分片模式下不支持。
+#    录入成绩后逐个分片结算，各分片记下已结算的成绩版本，没结算完的在 init_db 时补上。
+#    注单不会自动搬迁，分片数定下后不能再改（init_db 时检查）
+#    与 EXPOSURE_CAP 互斥：分片模式下设置了赔付上限，init_db / insert_bets 直接报错。
+#    吞吐：python bench.py confirm（8 个进程并发确认）在单核机器上只有 1.0–1.3 倍
+#    （约 500 → 570 张/s），没有达到数量级的提升；写锁拆开后还要多核才能并行写入，
+#    多核机器上的效果尚未实测
+SQLITE_SHARDS = 0 if USE_PG else int(os.getenv("SQLITE_SHARDS", "0"))
+SHARDED = SQLITE_SHARDS > 0
+SHARED_TABLES = ("results", "draw_numbers", "markets", "settled_draws")
+
+def shard_path(shard):
+    root, ext = os.path.splitext(SQLITE_PATH)
+    return f"{root}.shard{shard}{ext or '.db'}"
+
+def shard_of(group_id):
+    """群所在的分片编号（与进程无关的稳定哈希）"""
+    digest = hashlib.blake2b(str(group_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % SQLITE_SHARDS
+
+def _conn_key(group_id=None, join=False):
+    """连接键：None 为共享库，(kind, 分片) 为分片库；join 的分片连接能读到共享的开奖表"""
+    if not SHARDED or group_id is None:
+        return None
+    return ("join" if join else "shard", shard_of(group_id))
+
+def _shard_keys(join=False):
+    """不限群的查询要访问的连接键：分片模式下为每个分片，否则只有共享库"""
+    if not SHARDED:
+        return [None]
+    return [("join" if join else "shard", shard) for shard in range(SQLITE_SHARDS)]
+
+def _each_conn(group_id=None, join=False):
+    """按群查询只借出它所在分片的连接；不限群时依次借出每个分片的连接"""
+    keys = [_conn_key(group_id, join)] if group_id is not None else _shard_keys(join)
+    for key in keys:
+        conn = _get_conn(key)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+
+def _get_conn(key=None):
     if USE_PG:
-        conn = psycopg2.connect(os.getenv("DATABASE_URL"))
-        conn.autocommit = True
-        return conn
+        return _checkout_pg()
     else:
-        return sqlite3.connect("data.db", check_same_thread=False)
+        return _checkout_sqlite(key)
+
+
+# ✅ 统一获取连接函数（从连接池借出，用完 close() 即归还）
+def get_conn(group_id=None):
+    """传入 group_id 时借出该群所在分片的连接（未分片时与共享库相同）"""
+    return _get_conn(_conn_key(group_id))
+
+
+@contextmanager
+def _transaction(key=None):
+    conn = _checkout_pg() if USE_PG else _sqlite_write_conn(key)
+    try:
+        if USE_PG:
+            conn.autocommit = False   # 归还时会恢复 autocommit
+        elif not conn.in_transaction:
+            # SQLite 默认不会为 DDL / SELECT 自动开事务；IMMEDIATE 一开始就拿写锁
+            conn.execute("BEGIN IMMEDIATE")
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-# ✅ 初始化表结构（只需执行一次）
-def init_db():
-    conn = get_conn()
-    cursor = conn.cursor()
 
+def transaction(group_id=None):
+    """借出连接（传入 group_id 时为该群所在分片）并开启事务：正常结束提交，出错回滚，最后归还连接"""
+    return _transaction(_conn_key(group_id))
+
+
+def pool_stats():
+    """返回连接池计数器快照（SQLite 下含写线程计数）"""
+    with _pool_lock:
+        return dict(POOL_STATS) if USE_PG else dict(POOL_STATS, **WRITER_STATS)
+
+
+def close_pool():
+    """关闭所有空闲连接（进程退出前调用）"""
+    global _pg_warmed
+    with _pool_lock:
+        idle, _pg_idle[:] = list(_pg_idle), []
+        _pg_warmed = False
+    for conn in idle:
+        _pg_discard(conn)
+    # 写线程处理完队列里的写操作再退出
+    with _pool_lock:
+        writers = list(_sqlite_writers.values())
+        _sqlite_writers.clear()
+    for writer in writers:
+        writer.stop()
+    with _pool_lock:
+        idle = [conn for conns in _sqlite_pools.values() for conn in conns]
+        for conns in _sqlite_pools.values():
+            conns.clear()
+    for conn in idle:
+        conn.close()
+    conns = getattr(_sqlite_local, "conns", None) or {}
+    for conn in conns.values():
+        conn.close()
+    conns.clear()
+
+# ✅ 数据库结构迁移：按版本号顺序执行，已执行的版本记录在 schema_version 表
+MIGRATIONS = []
+
+def migration(version):
+    """注册一个迁移函数，函数接收 cursor，在独立事务中执行"""
+    def register(fn):
+        MIGRATIONS.append((version, fn))
+        return fn
+    return register
+
+@migration(1)
+def _m001_base_tables(cursor):
     if USE_PG:
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS bets (
@@ -94,48 +1004,343 @@ def init_db():
         )
         """)
 
-    conn.commit()
-    conn.close()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS results (
+            bet_date TEXT,
+            market TEXT,
+            result_text TEXT,
+            PRIMARY KEY (bet_date, market)
+        )
+    """)
+
+@migration(2)
+def _m002_bets_indexes(cursor):
+    # 历史 / 佣金 / 重复 / 锁注查询都按 (group_id, bet_date) 过滤，
+    # 把这些查询要读的列也放进索引，走 index-only scan 不回表
+    if USE_PG:
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_bets_group_date
+            ON bets (group_id, bet_date)
+            INCLUDE (code, number, market, bet_type, amount, commission)
+        """)
+    else:
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_bets_group_date
+            ON bets (group_id, bet_date, code, number, market, bet_type, amount, commission)
+        """)
+    # 删除 / 统计按 (code, group_id)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bets_code_group ON bets (code, group_id)")
+
+@migration(3)
+def _m003_market_mask(cursor):
+    # market 从 "M,K,T" 字符串改为位掩码 + 市场数，SQL 可直接聚合 / 过滤
+    cursor.execute("ALTER TABLE bets ADD COLUMN market_mask INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE bets ADD COLUMN market_count INTEGER NOT NULL DEFAULT 1")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS markets (
+            code TEXT PRIMARY KEY,
+            bit INTEGER NOT NULL
+        )
+    """)
+    for code, bit in MARKET_BITS.items():
+        cursor.execute(_sql("INSERT INTO markets (code, bit) VALUES (%s, %s)"), (code, bit))
+
+    # 回填旧数据：market 是逗号分隔的单字母代码
+    mask_expr = " + ".join(
+        f"CASE WHEN market LIKE '%{code}%' THEN {bit} ELSE 0 END"
+        for code, bit in MARKET_BITS.items()
+    )
+    count_expr = " + ".join(
+        f"CASE WHEN market LIKE '%{code}%' THEN 1 ELSE 0 END" for code in MARKET_BITS
+    )
+    cursor.execute(f"UPDATE bets SET market_mask = {mask_expr}, market_count = {count_expr}")
+
+    # “某日某市场的所有注单”：每个市场一个部分索引
+    for code, bit in MARKET_BITS.items():
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_bets_market_{code} "
+            f"ON bets (bet_date) WHERE (market_mask & {bit}) <> 0"
+        )
+
+@migration(4)
+def _m004_draw_numbers(cursor):
+    # 开奖成绩结构化：每个中奖号码一行
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS draw_numbers (
+            bet_date {"DATE" if USE_PG else "TEXT"} NOT NULL,
+            market TEXT NOT NULL,
+            prize TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            number TEXT NOT NULL,
+            PRIMARY KEY (bet_date, market, prize, position)
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_draw_numbers_lookup
+        ON draw_numbers (bet_date, market, number)
+    """)
+    # 对奖从注单出发按号码查开奖，bets 也需要 (bet_date, number)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bets_date_number ON bets (bet_date, number)")
+
+    # 回填已有的 result_text
+    cursor.execute("SELECT bet_date, market, result_text FROM results")
+    rows = []
+    for bet_date, market, result_text in cursor.fetchall():
+        rows += _draw_rows(bet_date, market, parse_result_text(result_text or ""))
+    if rows:
+        cursor.executemany(
+            _sql("""
+                INSERT INTO draw_numbers (bet_date, market, prize, position, number)
+                VALUES (%s, %s, %s, %s, %s)
+            """),
+            [row[:5] for row in rows],   # perm_key 列由 v5 添加并回填
+        )
+
+@migration(5)
+def _m005_perm_key(cursor):
+    # box / ibox 按排列无关的 perm_key 对奖，注单和开奖号码都存一份并建索引
+    cursor.execute("ALTER TABLE bets ADD COLUMN perm_key TEXT")
+    cursor.execute("ALTER TABLE draw_numbers ADD COLUMN perm_key TEXT")
+    for table in ("bets", "draw_numbers"):
+        cursor.execute(f"SELECT DISTINCT number FROM {table}")
+        keys = [(perm_key(r[0]), r[0]) for r in cursor.fetchall()]
+        cursor.executemany(_sql(f"UPDATE {table} SET perm_key = %s WHERE number = %s"), keys)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bets_date_perm ON bets (bet_date, perm_key)")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_draw_numbers_perm
+        ON draw_numbers (bet_date, market, perm_key)
+    """)
+
+@migration(6)
+def _m006_settlements(cursor):
+    # 开奖后预先结算好的中奖行，“查看中奖”直接读取
+    date_type = "DATE" if USE_PG else "TEXT"
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS settlements (
+            bet_date {date_type} NOT NULL,
+            bet_id INTEGER NOT NULL,
+            group_id TEXT NOT NULL,
+            number TEXT NOT NULL,
+            bet_type TEXT NOT NULL,
+            mode TEXT,
+            amount NUMERIC NOT NULL,
+            market TEXT NOT NULL,
+            prize TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            winning_number TEXT NOT NULL,
+            payout NUMERIC NOT NULL,
+            PRIMARY KEY (bet_id, market, prize, position)
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_settlements_group_date
+        ON settlements (group_id, bet_date)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_settlements_draw
+        ON settlements (bet_date, market)
+    """)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS settled_draws (
+            bet_date {date_type} NOT NULL,
+            market TEXT NOT NULL,
+            winners INTEGER NOT NULL,
+            settled_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (bet_date, market)
+        )
+    """)
+
+    # 结算已录入的开奖
+    cursor.execute("SELECT DISTINCT bet_date, market FROM draw_numbers")
+    for bet_date, market in cursor.fetchall():
+        _settle_draw(cursor, bet_date, market)
+
+@migration(7)
+def _m007_daily_commission(cursor):
+    # 每群每日的下注额 / 佣金 / 注数汇总，随下注和删除增量维护，佣金报表直接读取
+    date_type = "DATE" if USE_PG else "TEXT"
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS daily_commission (
+            group_id TEXT NOT NULL,
+            bet_date {date_type} NOT NULL,
+            total_amount NUMERIC NOT NULL,
+            total_commission NUMERIC NOT NULL,
+            bet_count INTEGER NOT NULL,
+            PRIMARY KEY (group_id, bet_date)
+        )
+    """)
+    _rebuild_daily_commission(cursor)
+
+@migration(8)
+def _m008_exposure(cursor):
+    # 每个 (日期, 市场, 号码, 类型) 上已承担的最大赔付，随下注和删除增量维护
+    date_type = "DATE" if USE_PG else "TEXT"
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS exposure (
+            bet_date {date_type} NOT NULL,
+            market TEXT NOT NULL,
+            number TEXT NOT NULL,
+            bet_type TEXT NOT NULL,
+            liability NUMERIC NOT NULL,
+            PRIMARY KEY (bet_date, number, bet_type, market)
+        )
+    """)
+
+    # 回填已有注单
+    cursor.execute("SELECT bet_date, market_mask, number, bet_type, mode, amount FROM bets")
+    exposure = {}
+    for bet_date, mask, number, bet_type, mode, amount in cursor.fetchall():
+        _tally_exposure(exposure, str(bet_date), mask, number, bet_type, mode, amount)
+    _add_exposure(cursor, exposure)
+
+@migration(9)
+def _m009_slips(cursor):
+    # 每张注单（code）一行：最早下注日期决定锁注，(created_at, code) 做删除列表的分页键
+    date_type, ts_type = ("DATE", "TIMESTAMP") if USE_PG else ("TEXT", "TEXT")
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS slips (
+            group_id TEXT NOT NULL,
+            code TEXT NOT NULL,
+            bet_date {date_type} NOT NULL,
+            created_at {ts_type} NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (group_id, code)
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_slips_group_created
+        ON slips (group_id, created_at, code, bet_date)
+    """)
+    cursor.execute("""
+        INSERT INTO slips (group_id, code, bet_date, created_at)
+        SELECT group_id, code, MIN(bet_date), MIN(created_at)
+        FROM bets
+        GROUP BY group_id, code
+    """)
+
+@migration(10)
+def _m010_pending_slips(cursor):
+    # 待确认注单（多个 worker 进程共用）：按 (群, 注单消息, 用户) 存 JSON，过期时间为 unix 秒
+    id_type, real_type = ("BIGINT", "DOUBLE PRECISION") if USE_PG else ("INTEGER", "REAL")
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS pending_slips (
+            chat_id TEXT NOT NULL,
+            message_id {id_type} NOT NULL,
+            user_id {id_type} NOT NULL,
+            payload TEXT NOT NULL,
+            expires_at {real_type} NOT NULL,
+            PRIMARY KEY (chat_id, message_id, user_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_slips_expires ON pending_slips (expires_at)")
+
+@migration(11)
+def _m011_shard_settled_draws(cursor):
+    # 分片模式下每个分片记录自己按哪一版成绩结算过（见 settle_pending_shards）；
+    # 不回填，已有分片第一次启动时全部重新结算一遍（结算幂等）；bet_date 与 results 表一样存文本
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS shard_settled_draws (
+            bet_date TEXT NOT NULL,
+            market TEXT NOT NULL,
+            result_text TEXT,
+            winners INTEGER NOT NULL,
+            settled_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (bet_date, market)
+        )
+    """)
+
+def _migrate(key=None):
+    with _transaction(key) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    current = 0
+    for version, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        with _transaction(key) as conn:
+            cursor = conn.cursor()
+            if USE_PG:
+                # 多个进程同时启动时只让一个执行迁移
+                cursor.execute("SELECT pg_advisory_xact_lock(4004)")
+            cursor.execute(_sql("SELECT 1 FROM schema_version WHERE version = %s"), (version,))
+            if cursor.fetchone() is None:
+                logger.info(f"执行数据库迁移 v{version}：{fn.__name__}" + (f"（分片 {key[1]}）" if key else ""))
+                fn(cursor)
+                cursor.execute(_sql("INSERT INTO schema_version (version) VALUES (%s)"), (version,))
+        current = version
+    return current
+
+def _check_shard_files():
+    """已有的分片文件必须正好是 0 … SQLITE_SHARDS-1，否则分片数被改过，群会找不到自己的注单"""
+    root, ext = os.path.splitext(SQLITE_PATH)
+    pattern = re.compile(re.escape(os.path.basename(root)) + r"\.shard(\d+)" + re.escape(ext or ".db") + "$")
+    existing = sorted(
+        int(m.group(1))
+        for m in map(pattern.match, os.listdir(os.path.dirname(os.path.abspath(SQLITE_PATH))))
+        if m
+    )
+    if existing and existing != list(range(SQLITE_SHARDS)):
+        raise RuntimeError(
+            f"SQLITE_SHARDS={SQLITE_SHARDS} 与已有的分片文件 {existing} 不一致，分片数定下后不能修改"
+        )
+
+def migrate():
+    """执行所有未执行过的迁移（共享库和每个分片，各分片结构相同），返回当前结构版本号"""
+    _exposure_cap()
+    current = _migrate()
+    if not USE_PG:
+        # 持有共享库的写锁检查、创建分片：多个进程同时启动时依次进行，不会看到建了一半的分片
+        with _transaction():
+            _check_shard_files()
+            for key in _shard_keys() if SHARDED else []:
+                _migrate(key)
+    return current
+
+# ✅ 初始化表结构（只会执行尚未执行过的迁移）
+def init_db():
+    migrate()
+    settle_pending_shards()
+
+_Q_LOCKED_BETS_FOR_DATE = register_query("locked_bets_for_date", """
+    SELECT number, market, bet_type, amount, market_mask
+    FROM bets
+    WHERE group_id = %s AND bet_date = %s
+""")
+_Q_BET_HISTORY = register_query("bet_history", """
+    SELECT bet_date, code, number, bet_type, amount, market
+    FROM bets
+    WHERE group_id = %s AND bet_date BETWEEN %s AND %s
+    ORDER BY bet_date DESC
+""")
 
 def get_locked_bets_for_date(group_id, date_str):
-    conn = get_conn()
-    with conn:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT number, market, bet_type, amount
-            FROM bets
-            WHERE group_id = %s AND bet_date = %s
-        """, (group_id, date_str))
+    conn = get_conn(group_id)
+    try:
+        cur = run_query(conn.cursor(), _Q_LOCKED_BETS_FOR_DATE, (str(group_id), str(date_str)))
         return [
             {
                 "number": row[0],
                 "market": row[1],
                 "bet_type": row[2],
                 "amount": row[3],
+                "markets": markets_from_mask(row[4]),
             }
             for row in cur.fetchall()
         ]
+    finally:
+        conn.close()
 
 def get_bet_history(start_date, end_date, group_id):
-    conn = get_conn()
-    c = conn.cursor()
-    if USE_PG:
-        c.execute("""
-            SELECT bet_date, code, number, bet_type, amount, market
-            FROM bets
-            WHERE group_id = %s AND bet_date BETWEEN %s AND %s
-            ORDER BY bet_date DESC
-        """, (group_id, start_date, end_date))
-
-    else:
-        c.execute("""
-            SELECT bet_date, code, number, bet_type, amount, market
-            FROM bets
-            WHERE group_id = ? AND bet_date BETWEEN ? AND ?
-            ORDER BY bet_date DESC
-        """, (user_id, group_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')))
-    rows = c.fetchall()
-    data = [
+    conn = get_conn(group_id)
+    try:
+        c = run_query(conn.cursor(), _Q_BET_HISTORY, (str(group_id), str(start_date), str(end_date)))
+        rows = c.fetchall()
+    finally:
+        conn.close()
+    return [
         {
             "date": r[0],
             "code": r[1],
@@ -147,126 +1352,652 @@ def get_bet_history(start_date, end_date, group_id):
         for r in rows
     ]
 
-    conn.close()
-    return data
+# ✅ 每日佣金汇总（daily_commission 表）：下注 / 删除时在同一事务内增减，
+#    总额口径与原报表一致：amount × 市场数
+def _rebuild_daily_commission(cursor, group_id=None):
+    """从 bets 表重新计算汇总（整表或某个群）"""
+    where, params = "", ()
+    if group_id is not None:
+        where, params = "WHERE group_id = %s", (str(group_id),)
+    cursor.execute(_sql(f"DELETE FROM daily_commission {where}"), params)
+    cursor.execute(_sql(f"""
+        INSERT INTO daily_commission (group_id, bet_date, total_amount, total_commission, bet_count)
+        SELECT group_id, bet_date, SUM(amount * market_count), SUM(commission), COUNT(*)
+        FROM bets
+        {where}
+        GROUP BY group_id, bet_date
+    """), params)
 
-def get_commission_summary(start_date, end_date, group_id):
-    conn = get_conn()
-    c = conn.cursor()
+_Q_DAILY_COMMISSION_ADD = register_query("daily_commission_add", """
+    INSERT INTO daily_commission (group_id, bet_date, total_amount, total_commission, bet_count)
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (group_id, bet_date) DO UPDATE SET
+        total_amount = daily_commission.total_amount + excluded.total_amount,
+        total_commission = daily_commission.total_commission + excluded.total_commission,
+        bet_count = daily_commission.bet_count + excluded.bet_count
+""")
+_Q_DAILY_COMMISSION_PRUNE = register_query("daily_commission_prune", """
+    DELETE FROM daily_commission WHERE group_id = %s AND bet_count <= 0
+""")
+_Q_COMMISSION_SUMMARY = register_query("commission_summary", """
+    SELECT bet_date, total_amount, total_commission, bet_count
+    FROM daily_commission
+    WHERE group_id = %s
+      AND bet_date BETWEEN %s AND %s
+    ORDER BY bet_date DESC
+""")
 
-    if USE_PG:
-        # Postgres: 用 string_to_array + cardinality 计算 market 数量
-        c.execute("""
-            SELECT
-                TO_CHAR(bet_date, 'DD/MM') AS day,
-                SUM(amount * CARDINALITY(string_to_array(market, ','))) AS total_amount,
-                SUM(commission) AS total_commission
-            FROM bets
-            WHERE group_id = %s
-              AND bet_date BETWEEN %s AND %s
-            GROUP BY day
-            ORDER BY day DESC
-        """, (group_id, start_date, end_date))
-    else:
-        # SQLite: 用字符串方法计算 market 数量
-        c.execute("""
-            SELECT
-                strftime('%d/%m', bet_date) AS day,
-                SUM(
-                    amount * (
-                        LENGTH(market) - LENGTH(REPLACE(market, ',', '')) + 1
-                    )
-                ) AS total_amount,
-                SUM(commission) AS total_commission
-            FROM bets
-            WHERE group_id = ?
-              AND bet_date BETWEEN ? AND ?
-            GROUP BY day
-            ORDER BY day DESC
-        """, (
-            group_id,
-            start_date.strftime('%Y-%m-%d'),
-            end_date.strftime('%Y-%m-%d'),
-        ))
-
-    rows = c.fetchall()
-    conn.close()
+def _add_daily_commission(cursor, group_id, totals, sign=1):
+    """
+    totals: {bet_date: [总额, 佣金, 注数]}，按 sign 加到 / 减出汇总行。
+    按日期排序更新，并发事务加行锁的顺序一致，不会互相死锁。
+    """
+    run_query(cursor, _Q_DAILY_COMMISSION_ADD, [
+        (str(group_id), str(bet_date), sign * amount, sign * commission, sign * count)
+        for bet_date, (amount, commission, count) in sorted(totals.items(), key=lambda t: str(t[0]))
+    ], many=True)
+    if sign < 0:
+        run_query(cursor, _Q_DAILY_COMMISSION_PRUNE, (str(group_id),))
+
+def rebuild_daily_commission(group_id=None):
+    """重建每日佣金汇总（数据修复用：python db.py rebuild_commission）"""
+    for key in [_conn_key(group_id)] if group_id is not None else _shard_keys():
+        with _transaction(key) as conn:
+            _rebuild_daily_commission(conn.cursor(), group_id)
+
+def _day_label(bet_date):
+    if isinstance(bet_date, str):
+        bet_date = datetime.strptime(bet_date[:10], "%Y-%m-%d").date()
+    return bet_date.strftime("%d/%m")
+
+def get_commission_summary(start_date, end_date, group_id):
+    """某群一段日期内每天的下注总额 / 佣金 / 注数，按日期从新到旧（每天一行）"""
+    conn = get_conn(group_id)
+    try:
+        c = run_query(conn.cursor(), _Q_COMMISSION_SUMMARY, (str(group_id), str(start_date), str(end_date)))
+        rows = c.fetchall()
+    finally:
+        conn.close()
 
     return [
         {
-            "day": r[0],
+            "day": _day_label(r[0]),
             "total_amount": float(r[1]),
-            "total_commission": float(r[2])
+            "total_commission": float(r[2]),
+            "bet_count": r[3],
         }
         for r in rows
     ]
 
-def get_recent_bet_codes(group_id=None):
-    from datetime import datetime, time
-    import pytz
+# ✅ 可删除的注单 code：锁注条件（下注日期当晚 19:00）直接写进 WHERE
+LOCK_HOUR = 19
 
-    conn = get_conn()
-    c = conn.cursor()
+def _first_open_bet_date():
+    """还没锁注的最早下注日期：19:00 前是今天，之后是明天（马来西亚时间）"""
+    tz = pytz.timezone("Asia/Kuala_Lumpur")
+    now = datetime.now(tz)
+    today = now.date()
+    return today if now.hour < LOCK_HOUR else today + timedelta(days=1)
 
-    try:
-        tz = pytz.timezone("Asia/Kuala_Lumpur")
-        now = datetime.now(tz)
-        today = now.date()
-        lock_datetime_today = datetime.combine(today, time(19, 0)).astimezone(tz)
-
-        # 查询所有 code 和 bet_date（ORDER BY 需要的字段必须都出现在 SELECT 中）
-        if group_id:
-            query = """
-                SELECT DISTINCT ON (code) code, bet_date, created_at
-                FROM bets
-                WHERE group_id = %s
-                ORDER BY code, created_at DESC
-            """
-            c.execute(query, (group_id,))
-        else:
-            query = """
-                SELECT DISTINCT ON (code) code, bet_date, created_at
-                FROM bets
-                ORDER BY code, created_at DESC
-            """
-            c.execute(query)
+_Q_CODE_PAGE_FIRST = register_query("code_page_first", """
+    SELECT code, created_at
+    FROM slips
+    WHERE group_id = %s AND bet_date >= %s
+    ORDER BY created_at DESC, code DESC LIMIT %s
+""")
+_Q_CODE_PAGE_AFTER = register_query("code_page_after", """
+    SELECT code, created_at
+    FROM slips
+    WHERE group_id = %s AND bet_date >= %s AND (created_at, code) < (%s, %s)
+    ORDER BY created_at DESC, code DESC LIMIT %s
+""")
+_Q_OPEN_CODES = register_query("open_codes", """
+    SELECT code, created_at FROM slips WHERE bet_date >= %s ORDER BY created_at DESC, code DESC
+""")
+_Q_OPEN_CODES_FOR_GROUP = register_query("open_codes_for_group", """
+    SELECT code, created_at FROM slips WHERE bet_date >= %s AND group_id = %s ORDER BY created_at DESC, code DESC
+""")
 
-        rows = c.fetchall()
-        conn.close()
+def get_bet_code_page(group_id, cursor=None, page_size=5):
+    """
+    某群未锁注的注单 code，按下注时间从新到旧分页（keyset 分页）。
 
-        # 过滤出未锁注的 code
-        valid_codes = []
-        for code, bet_datetime, created_at in rows:
-            if isinstance(bet_datetime, str):
-                bet_datetime = datetime.fromisoformat(bet_datetime)
-            bet_date = bet_datetime
-            lock_datetime = datetime.combine(bet_date, time(19, 0)).astimezone(tz)
+    cursor 为上一页返回的 next_cursor（首页传 None），每页只查 page_size + 1 行
+    (idx_slips_group_created)，与历史注单数量无关。
+    返回 (codes, next_cursor)；没有下一页时 next_cursor 为 None。
+    """
+    params = [str(group_id), str(_first_open_bet_date())]
+    if cursor is not None:
+        params.extend(cursor)
+    params.append(page_size + 1)
 
-            # 如果当前时间早于该注单的锁定时间 → 可显示
-            if now < lock_datetime:
-                valid_codes.append(code)
+    conn = get_conn(group_id)
+    try:
+        name = _Q_CODE_PAGE_FIRST if cursor is None else _Q_CODE_PAGE_AFTER
+        rows = run_query(conn.cursor(), name, params).fetchall()
+    finally:
+        conn.close()
 
-        return valid_codes
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = (rows[-1][1], rows[-1][0])
+    return [r[0] for r in rows], next_cursor
 
+def get_recent_bet_codes(group_id=None):
+    """未锁注的全部注单 code（新到旧）；分页显示请用 get_bet_code_page"""
+    params = [str(_first_open_bet_date())]
+    if group_id:
+        params.append(str(group_id))
+
+    rows = []
+    try:
+        for conn in _each_conn(group_id or None):
+            rows += run_query(conn.cursor(), _Q_OPEN_CODES_FOR_GROUP if group_id else _Q_OPEN_CODES, params).fetchall()
     except Exception as e:
         logger.error(f"❌ 读取下注 code 出错: {e}")
         return []
+    if not group_id and SHARDED:
+        # 各分片合并后按下注时间从新到旧
+        rows.sort(key=lambda r: (r[1], r[0]), reverse=True)
+    return [r[0] for r in rows]
+
+# ✅ 号码赔付风险（exposure 表）：确认下注时在同一事务内累加并检查上限，删除时扣减。
+#    Postgres 下 upsert 对行加锁直到提交，SQLite 下 BEGIN IMMEDIATE 串行写入，
+#    并发确认的注单不会一起越过上限；按键排序更新，加锁顺序一致，不会死锁
+#    分片模式（SQLITE_SHARDS > 0）不支持赔付上限，两者只能二选一（_exposure_cap 检查）
+EXPOSURE_CAP = float(os.getenv("EXPOSURE_CAP", "0"))   # 单号码单类型单市场的赔付上限，0 为不限
+
+class ExposureLimitExceeded(Exception):
+    """确认下注后某些号码的赔付会超过上限；over 为 [(日期, 市场, 号码, 类型, 赔付)]"""
+    def __init__(self, over):
+        self.over = over
+        super().__init__(f"{len(over)} 个号码超过赔付上限 RM{EXPOSURE_CAP:.2f}")
+
+def _tally_exposure(exposure, bet_date, mask, number, bet_type, mode, amount, sign=1):
+    for market, n, liability in bet_exposure(number, bet_type, mode, amount, markets_from_mask(mask)):
+        key = (bet_date, market, n, bet_type)
+        exposure[key] = exposure.get(key, 0) + sign * liability
+
+def _fetch_exposure(cursor, keys):
+    """按 (日期, 号码) 走主键批量读取已有赔付，返回 {key: liability}"""
+    wanted = set(keys)
+    by_date = {}
+    for bet_date, _, number, _ in wanted:
+        by_date.setdefault(bet_date, set()).add(number)
+
+    found = {}
+    for bet_date, numbers in by_date.items():
+        numbers = sorted(numbers)
+        for i in range(0, len(numbers), 500):
+            chunk = numbers[i:i + 500]
+            cursor.execute(_sql(f"""
+                SELECT market, number, bet_type, liability
+                FROM exposure
+                WHERE bet_date = %s AND number IN ({", ".join(["%s"] * len(chunk))})
+            """), [bet_date, *chunk])
+            for market, number, bet_type, liability in cursor.fetchall():
+                key = (bet_date, market, number, bet_type)
+                if key in wanted:
+                    found[key] = float(liability)
+    return found
+
+_Q_EXPOSURE_ADD = register_query("exposure_add", """
+    INSERT INTO exposure (bet_date, market, number, bet_type, liability)
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (bet_date, number, bet_type, market) DO UPDATE SET
+        liability = exposure.liability + excluded.liability
+""")
+_Q_EXPOSURE_PRUNE = register_query("exposure_prune", """
+    DELETE FROM exposure WHERE bet_date = %s AND liability < 0.005
+""")
+
+def _add_exposure(cursor, exposure, sign=1, cap=0):
+    """
+    exposure: {(日期, 市场, 号码, 类型): 赔付}，按 sign 加到 / 减出 exposure 表。
+    cap > 0 时返回加完后超过上限的 [(日期, 市场, 号码, 类型, 赔付)]。
+    """
+    keys = sorted(exposure)
+    run_query(cursor, _Q_EXPOSURE_ADD, [(*key, sign * exposure[key]) for key in keys], many=True)
+
+    if sign < 0:
+        dates = sorted({key[0] for key in keys})
+        run_query(cursor, _Q_EXPOSURE_PRUNE, [(d,) for d in dates], many=True)
+        return []
+    if cap <= 0:
+        return []
+    return [
+        (*key, liability)
+        for key, liability in sorted(_fetch_exposure(cursor, keys).items())
+        if liability > cap + 0.005
+    ]
+
+def _exposure_cap(cap=None):
+    """
+    生效的赔付上限（None 为 EXPOSURE_CAP）。分片模式下每个分片各自累加赔付，
+    不同分片同时确认的注单可能一起越过上限，所以分片模式不支持上限
+    """
+    cap = EXPOSURE_CAP if cap is None else cap
+    if cap > 0 and SHARDED:
+        raise RuntimeError("分片模式（SQLITE_SHARDS>0）不支持赔付上限 EXPOSURE_CAP，请二选一")
+    return cap
+
+def check_exposure(bets, cap=None):
+    """
+    预检一张已计价的注单（不写库）：返回下注后会超过上限的
+    [(日期, 市场, 号码, 类型, 赔付)]，只查注单涉及的号码。
+    """
+    cap = _exposure_cap(cap)
+    if cap <= 0:
+        return []
+    exposure = {}
+    for bet in bets:
+        _tally_exposure(exposure, bet["date"], market_mask(bet["markets"]), bet["number"],
+                        bet["type"], bet.get("mode"), bet["amount"])
 
-def delete_bet_and_commission(code, group_id):
     conn = get_conn()
-    c = conn.cursor()
     try:
-        if USE_PG:
-            c.execute("DELETE FROM bets WHERE code = %s AND group_id = %s", (code, group_id))
-        else:
-            c.execute("DELETE FROM bets WHERE code = ? AND group_id = ?", (code, group_id))
-        conn.commit()
+        existing = _fetch_exposure(conn.cursor(), exposure)
+    finally:
         conn.close()
-        return True
+    over = []
+    for key in sorted(exposure):
+        liability = existing.get(key, 0) + exposure[key]
+        if liability > cap + 0.005:
+            over.append((*key, liability))
+    return over
+
+_Q_CODE_TOTALS = register_query("code_totals", """
+    SELECT bet_date, SUM(amount * market_count), SUM(commission), COUNT(*)
+    FROM bets
+    WHERE code = %s AND group_id = %s
+    GROUP BY bet_date
+""")
+_Q_CODE_BETS = register_query("code_bets", """
+    SELECT bet_date, market_mask, number, bet_type, mode, amount
+    FROM bets
+    WHERE code = %s AND group_id = %s
+""")
+_Q_CODE_BET_DATE = register_query("code_bet_date", """
+    SELECT MIN(bet_date) FROM bets WHERE code = %s AND group_id = %s
+""")
+_Q_CODE_BET_COUNT = register_query("code_bet_count", """
+    SELECT COUNT(*) FROM bets WHERE code = %s AND group_id = %s
+""")
+_Q_BETS_DELETE_BY_CODE = register_query("bets_delete_by_code", """
+    DELETE FROM bets WHERE code = %s AND group_id = %s
+""")
+_Q_SLIP_DELETE = register_query("slip_delete", """
+    DELETE FROM slips WHERE code = %s AND group_id = %s
+""")
+
+def get_code_bet_date(code, group_id):
+    """某张注单（code）最早的下注日期，不存在返回 None"""
+    conn = get_conn(group_id)
+    try:
+        return run_query(conn.cursor(), _Q_CODE_BET_DATE, (code, str(group_id))).fetchone()[0]
+    finally:
+        conn.close()
+
+def get_bet_count_for_code(code, group_id):
+    conn = get_conn(group_id)
+    try:
+        return run_query(conn.cursor(), _Q_CODE_BET_COUNT, (code, str(group_id))).fetchone()[0]
+    finally:
+        conn.close()
+
+def delete_bet_and_commission(code, group_id):
+    """删除某群某个 code 的全部注单，同一事务内扣减每日佣金汇总和号码赔付；返回删除的注数"""
+    def write(c):
+        key = (code, str(group_id))
+        totals = {r[0]: r[1:] for r in run_query(c, _Q_CODE_TOTALS, key).fetchall()}
+        exposure = {}
+        for bet_date, mask, number, bet_type, mode, amount in run_query(c, _Q_CODE_BETS, key).fetchall():
+            _tally_exposure(exposure, str(bet_date), mask, number, bet_type, mode, amount)
+
+        deleted = run_query(c, _Q_BETS_DELETE_BY_CODE, key).rowcount
+        run_query(c, _Q_SLIP_DELETE, key)
+        _add_daily_commission(c, group_id, totals, sign=-1)
+        _add_exposure(c, exposure, sign=-1)
+        return deleted
+
+    try:
+        return _write(_conn_key(group_id), write)
     except Exception as e:
         logger.error(f"删除失败：{e}")
+        return 0
+
+def get_bets_on_market(bet_date, market, group_id=None):
+    """某日下在某个市场上的全部注单（走 idx_bets_market_* 部分索引）"""
+    bit = MARKET_BITS[market]
+    sql = f"""
+        SELECT id, group_id, number, bet_type, mode, amount
+        FROM bets
+        WHERE bet_date = %s AND (market_mask & {bit}) <> 0
+    """
+    params = [bet_date]
+    if group_id is not None:
+        sql += " AND group_id = %s"
+        params.append(group_id)
+
+    rows = []
+    for conn in _each_conn(group_id):
+        c = conn.cursor()
+        c.execute(_sql(sql), params)
+        rows += c.fetchall()
+    return [
+        {
+            "id": r[0],
+            "group_id": r[1],
+            "number": r[2],
+            "bet_type": r[3],
+            "mode": r[4],
+            "amount": r[5],
+        }
+        for r in rows
+    ]
+
+_Q_DUPLICATE_BETS = register_query("duplicate_bets", """
+    SELECT bet_date, number, market, bet_type, COUNT(*)
+    FROM bets
+    WHERE group_id = %s AND bet_date = %s
+    GROUP BY bet_date, number, market, bet_type
+    HAVING COUNT(*) > 1
+    ORDER BY bet_date DESC
+""")
+
+def get_duplicate_bets(group_id, bet_date):
+    """返回某群某日重复下注的 (bet_date, number, market, bet_type, count)"""
+    conn = get_conn(group_id)
+    try:
+        return run_query(conn.cursor(), _Q_DUPLICATE_BETS, (str(group_id), str(bet_date))).fetchall()
+    finally:
         conn.close()
-        return False
+
+BET_COLUMNS = (
+    "agent_id, group_id, bet_date, market, market_mask, market_count, number, "
+    "perm_key, bet_type, mode, amount, potential_win, commission, code"
+)
+
+def _bet_row(bet, agent_id, group_id, code):
+    return (
+        agent_id,
+        group_id,
+        bet['date'],
+        ','.join(str(m) for m in bet['markets']),   # 仅用于显示
+        market_mask(bet['markets']),
+        len(bet['markets']),
+        bet['number'],
+        perm_key(bet['number']),
+        bet['type'],
+        bet.get('mode') or '',       # 如果 mode 可能为 None，给个默认
+        bet['amount'],
+        bet['potential_win'],
+        bet['commission'],
+        code,
+    )
+
+# SQLite 逐行 executemany 用；Postgres 用 execute_values 拼多行 VALUES，不走预编译
+_Q_BET_INSERT = register_query("bet_insert", f"""
+    INSERT INTO bets ({BET_COLUMNS}) VALUES ({', '.join(['%s'] * len(BET_COLUMNS.split(',')))})
+""")
+_Q_SLIP_INSERT = register_query("slip_insert", """
+    INSERT INTO slips (group_id, code, bet_date)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (group_id, code) DO NOTHING
+""")
+
+# 单条 INSERT 语句最多带的行数；一般注单远小于此，整张单一条语句、一次往返
+INSERT_PAGE_SIZE = 5000
+
+def insert_bets(bets, agent_id, group_id, code, exposure_cap=None):
+    """
+    把一张注单（同一个 code）在一个事务里一次性写入 bets 表。
+
+    bets 可以是列表，也可以是 engine.iter_priced 之类的生成器（边算边写）。
+    Postgres 用 execute_values 拼成多行 INSERT ... RETURNING id，
+    SQLite 交给写线程 executemany（与其它写操作合并提交）。返回新记录的 id 列表（顺序与 bets 一致）。
+
+    同一事务内累加号码赔付；超过 exposure_cap（默认 EXPOSURE_CAP）时整张注单
+    回滚并抛出 ExposureLimitExceeded。
+    """
+    cap = _exposure_cap(exposure_cap)
+    totals, exposure = {}, {}
+    rows = _tally_rows((_bet_row(bet, agent_id, group_id, code) for bet in bets), totals, exposure)
+    if not USE_PG:
+        # 交给写线程前在本线程算好，写线程只管写库
+        rows = list(rows)
+
+    def write(cursor):
+        if USE_PG:
+            ids = [r[0] for r in execute_values(
+                cursor,
+                f"INSERT INTO bets ({BET_COLUMNS}) VALUES %s RETURNING id",
+                rows,
+                page_size=INSERT_PAGE_SIZE,
+                fetch=True,
+            )]
+        else:
+            run_query(cursor, _Q_BET_INSERT, rows, many=True)
+            count = cursor.rowcount
+            ids = []
+            if count > 0:
+                # 同一事务内 AUTOINCREMENT 的 id 是连续的
+                cursor.execute("SELECT last_insert_rowid()")
+                last_id = cursor.fetchone()[0]
+                ids = list(range(last_id - count + 1, last_id + 1))
+
+        # 同一事务内登记注单、累加每日佣金汇总和号码赔付，超限则回滚
+        if totals:
+            run_query(cursor, _Q_SLIP_INSERT, (str(group_id), code, str(min(totals, key=str))))
+        _add_daily_commission(cursor, group_id, totals)
+        over = _add_exposure(cursor, exposure, cap=cap)
+        if over:
+            raise ExposureLimitExceeded(over)
+        return ids
+
+    return _write(_conn_key(group_id), write)
+
+def _tally_rows(rows, totals, exposure):
+    """
+    边写边累计：按下注日期的 [总额, 佣金, 注数]（与 daily_commission 口径一致），
+    以及每个 (日期, 市场, 号码, 类型) 的赔付
+    """
+    for row in rows:
+        t = totals.setdefault(row[2], [0, 0, 0])
+        t[0] += row[10] * row[5]    # amount × market_count
+        t[1] += row[12]             # commission
+        t[2] += 1
+        _tally_exposure(exposure, str(row[2]), row[4], row[6], row[8], row[9], row[10])
+        yield row
+
+# ✅ 待确认注单表（pending.TablePendingStore 的存储）
+_Q_PENDING_PUT = register_query("pending_put", """
+    INSERT INTO pending_slips (chat_id, message_id, user_id, payload, expires_at)
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (chat_id, message_id, user_id) DO UPDATE SET
+        payload = excluded.payload, expires_at = excluded.expires_at
+""")
+_Q_PENDING_TAKE = register_query("pending_take", """
+    DELETE FROM pending_slips
+    WHERE chat_id = %s AND message_id = %s AND user_id = %s
+    RETURNING payload, expires_at
+""")
+_Q_PENDING_PURGE = register_query("pending_purge", """
+    DELETE FROM pending_slips WHERE expires_at <= %s
+""")
+_Q_PENDING_TRIM = register_query("pending_trim", """
+    DELETE FROM pending_slips
+    WHERE expires_at < (
+        SELECT expires_at FROM pending_slips ORDER BY expires_at DESC LIMIT 1 OFFSET %s
+    )
+""")
+_Q_PENDING_LATEST = register_query("pending_latest", """
+    SELECT expires_at FROM pending_slips ORDER BY expires_at DESC LIMIT %s
+""")
+_Q_PENDING_TRIM_BEFORE = register_query("pending_trim_before", """
+    DELETE FROM pending_slips WHERE expires_at < %s
+""")
+
+def put_pending_slip(chat_id, message_id, user_id, payload, expires_at):
+    _write(_conn_key(chat_id), lambda c: run_query(
+        c, _Q_PENDING_PUT, (str(chat_id), message_id, user_id, payload, expires_at)
+    ))
+
+def take_pending_slip(chat_id, message_id, user_id):
+    """原子地取出并删除一条待确认注单，返回 (payload, expires_at)，不存在返回 None"""
+    return _write(_conn_key(chat_id), lambda c: run_query(
+        c, _Q_PENDING_TAKE, (str(chat_id), message_id, user_id)
+    ).fetchone())
+
+def purge_pending_slips(now, max_entries):
+    """删除已过期的待确认注单，并只保留最晚过期的 max_entries 条；返回删除条数"""
+    if not SHARDED:
+        def purge(c):
+            purged = run_query(c, _Q_PENDING_PURGE, (now,)).rowcount
+            return purged + run_query(c, _Q_PENDING_TRIM, (max_entries - 1,)).rowcount
+        return _write(None, purge)
+
+    # 分片模式：各分片取最晚的 max_entries 个过期时间，合并出全局第 max_entries 个作为界线
+    def purge_expired(c):
+        purged = run_query(c, _Q_PENDING_PURGE, (now,)).rowcount
+        return purged, [r[0] for r in run_query(c, _Q_PENDING_LATEST, (max_entries,)).fetchall()]
+
+    purged = 0
+    latest = []
+    for key in _shard_keys():
+        n, expires = _write(key, purge_expired)
+        purged += n
+        latest += expires
+    if len(latest) >= max_entries:
+        cutoff = sorted(latest, reverse=True)[max_entries - 1]
+        for key in _shard_keys():
+            purged += _write(key, lambda c: run_query(c, _Q_PENDING_TRIM_BEFORE, (cutoff,)).rowcount)
+    return purged
 
 # 导出连接和游标
-__all__ = ["conn", "cursor", "get_bet_history", "get_commission_summary", "get_recent_bet_codes", "delete_bet_and_commission"]
+__all__ = ["get_conn", "pool_stats", "get_result_by_date", "get_results_for_date", "results_cache_stats", "close_pool", "get_bet_history", "get_commission_summary", "rebuild_daily_commission", "get_recent_bet_codes", "get_bet_code_page", "delete_bet_and_commission", "get_code_bet_date", "get_bet_count_for_code", "get_recorded_markets", "settle", "settle_draw", "settle_pending_shards", "get_group_winnings", "get_group_winning_bets", "get_draw_payouts", "draw_payout", "get_bets_on_market", "get_duplicate_bets", "insert_bets", "check_exposure", "ExposureLimitExceeded", "transaction", "put_pending_slip", "take_pending_slip", "purge_pending_slips", "register_query", "run_query", "check_queries", "init_db", "migrate"]
+
+
+# ---------- 维护命令 ----------
+if __name__ == "__main__":
+    import sys
+
+    def check_pool(rounds=20):
+        """
+        让连接在连接池里反复借出、归还，返回问题列表（空列表表示全部通过）：
+          - 每轮借出后执行具名查询（Postgres 下走 PREPARE / EXECUTE）
+          - Postgres 下每隔一轮把底层连接断开再归还，下一轮只能新建连接；
+            新连接可能复用旧连接的内存地址，不能被当成已 PREPARE
+          - 结束后预编译记录只属于连接池里仍然存活的空闲连接
+        """
+        problems = []
+        for i in range(rounds):
+            conn = get_conn()
+            try:
+                run_query(conn.cursor(), _Q_CODE_BET_COUNT, ("check_pool", 0)).fetchone()
+            except Exception as e:
+                problems.append(f"第 {i + 1} 轮：{e}")
+            finally:
+                if USE_PG and i % 2:
+                    conn._raw.close()
+                conn.close()
+        if USE_PG:
+            with _pool_lock:
+                idle = list(_pg_idle)
+            stale = [c for c in list(_prepared.keys()) + list(_last_used.keys()) if c not in idle]
+            if stale:
+                problems.append(f"{len(stale)} 条已断开的连接仍留有预编译或使用记录")
+        return problems
+
+    def check_query_results():
+        """
+        在当前后端写入一组样例开奖 / 注单 / code（事务最后回滚，不留数据），比较结算和
+        code 分页经具名查询得到的结果，与改用注册表之前按后端拼接的 SQL（_sql 换占位符）
+        的结果是否逐行一致，返回问题列表（空列表表示全部通过）
+        """
+        bet_date, open_date, groups = "1999-01-01", str(_first_open_bet_date()), ("check_a", "check_b")
+        draw = {"1st": ["1234"], "2nd": ["5678"], "3rd": ["9012"],
+                "special": ["4321", "8765"], "consolation": ["2109", "1234"]}
+        bets = [
+            {"date": bet_date, "markets": markets, "number": number, "type": bet_type, "mode": mode,
+             "amount": amount, "potential_win": 0, "commission": 0}
+            for markets in (["M"], ["M", "K"], ["T"])
+            for number, bet_type, mode, amount in (
+                ("1234", "B", "", 1), ("3412", "B", "box", 2), ("2143", "S", "ibox", 24),
+                ("8765", "A", "", 3), ("2109", "C", "", 1), ("0000", "B", "", 5),
+            )
+        ]
+        problems = []
+        conn = _checkout_pg() if USE_PG else _sqlite_write_conn()
+        try:
+            if USE_PG:
+                conn.autocommit = False
+            c = conn.cursor()
+            for market in ("M", "K"):
+                for row in _draw_rows(bet_date, market, draw):
+                    run_query(c, _Q_DRAW_NUMBERS_INSERT, row)
+            for i, group_id in enumerate(groups):
+                run_query(c, _Q_BET_INSERT, [_bet_row(b, 0, group_id, f"C{i}") for b in bets], many=True)
+                for n in range(7):
+                    # 后两张与前一张同一秒，分页要靠 code 排出先后
+                    c.execute(_sql("INSERT INTO slips (group_id, code, bet_date, created_at) VALUES (%s, %s, %s, %s)"),
+                              (group_id, f"C{n}", open_date, f"2000-01-01 10:00:0{min(n, 4)}"))
+
+            for group_id in (None, groups[0]):
+                for market in (None, "M"):
+                    sql, params = _settlement_sql(bet_date, group_id, market)
+                    c.execute(_sql(sql), params)
+                    old = c.fetchall()
+                    new = run_query(c, _Q_SETTLEMENT[group_id is not None, market is not None], params).fetchall()
+                    if not old or old != new:
+                        problems.append(f"结算（群 {group_id}，市场 {market}）：旧 {len(old)} 行，新 {len(new)} 行，不一致")
+
+            for page_size in (2, 3, 7):
+                cursor = None
+                while True:
+                    sql = "SELECT code, created_at FROM slips WHERE group_id = %s AND bet_date >= %s"
+                    params = [groups[0], open_date]
+                    if cursor is not None:
+                        sql += " AND (created_at, code) < (%s, %s)"
+                        params.extend(cursor)
+                    sql += " ORDER BY created_at DESC, code DESC LIMIT %s"
+                    params.append(page_size + 1)
+                    c.execute(_sql(sql), params)
+                    old = c.fetchall()
+                    new = run_query(c, _Q_CODE_PAGE_FIRST if cursor is None else _Q_CODE_PAGE_AFTER, params).fetchall()
+                    if old != new:
+                        problems.append(f"code 分页（每页 {page_size}，游标 {cursor}）：{old} ≠ {new}")
+                        break
+                    if len(old) <= page_size:
+                        break
+                    cursor = (old[page_size - 1][1], old[page_size - 1][0])
+        except Exception as e:
+            problems.append(f"执行出错：{e}")
+        finally:
+            conn.rollback()
+            conn.close()
+        return problems
+
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["rebuild_commission"]:
+        init_db()
+        rebuild_daily_commission()
+        print("✅ 每日佣金汇总已从 bets 表重建")
+    elif sys.argv[1:] == ["check_queries"]:
+        init_db()
+        # 编译检查 + 结算 / 分页结果与旧 SQL 对比
+        problems = check_queries() + check_query_results()
+        for p in problems:
+            print(f"❌ {p}")
+        print(f"{'✅' if not problems else '⚠️'} 已检查 {len(QUERIES)} 条具名查询及结算 / 分页结果，{len(problems)} 个问题")
+        sys.exit(1 if problems else 0)
+    elif sys.argv[1:] == ["check_pool"]:
+        init_db()
+        problems = check_pool()
+        for p in problems:
+            print(f"❌ {p}")
+        print(f"{'✅' if not problems else '⚠️'} 连接池借出 / 归还检查：{pool_stats()}，{len(problems)} 个问题")
+        sys.exit(1 if problems else 0)
+    else:
+        print("用法：python db.py rebuild_commission | check_queries | check_pool")
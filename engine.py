@@ -1,8 +1,12 @@
 # engine.py
 
 import math
+import threading
+from array import array
 from collections import Counter
-from typing import List, Dict
+from typing import Dict, Iterable, Iterator, List
+
+from parser import MARKET_BITS, market_mask
 
 # 标准赔率（RM1）── 
 STANDARD_ODDS = {
@@ -12,16 +16,148 @@ STANDARD_ODDS = {
     **{m: {"B": 3045, "S": 4095, "A": 740.25,"C": 246.75} for m in ("H","E")},
 }
 
+# 市场的固定顺序（多市场累加时使用）
+_MARKET_ORDER = list(MARKET_BITS)
+
 # 代理抽水比例 :contentReference[oaicite:1]{index=1}
 COMMISSION_RATES = {
     "MKTS": 0.26,
     "HE":   0.19,
 }
 
+# 各奖级派彩（相对 STANDARD_ODDS 头奖）的比例，未列出的奖级不派彩：
+#   B 大：五个奖级都中，按 2500/1000/500/180/60 折算
+#   S 小：只中头/二/三奖，按 3500/2000/1000 折算
+#   A：只中头奖
+#   C：头/二/三奖任一，派彩相同
+PRIZE_RATIOS = {
+    "B": {"1st": 1.0, "2nd": 0.4, "3rd": 0.2, "special": 0.072, "consolation": 0.024},
+    "S": {"1st": 1.0, "2nd": 4 / 7, "3rd": 2 / 7},
+    "A": {"1st": 1.0},
+    "C": {"1st": 1.0, "2nd": 1.0, "3rd": 1.0},
+}
+
+# ✅ 0000–9999 全部号码的组合数 / 排列键 / 排列列表，首次使用时一次性构建：
+#   _PERM_COMB[n]    组合数（array 'B'）
+#   _PERM_KEY[n]     数字排序后的号码，如 4321 → 1234（array 'H'）
+#   _PERM_LIST       所有排列键的排列按键顺序拼接（array 'H'），
+#                    键 k 的排列为 _PERM_LIST[_PERM_START[k]:_PERM_START[k] + _PERM_COMB[k]]
+_PERM_COMB = None
+_PERM_KEY = None
+_PERM_START = None
+_PERM_LIST = None
+_perm_lock = threading.Lock()
+
+def _perm_tables():
+    global _PERM_COMB, _PERM_KEY, _PERM_START, _PERM_LIST
+    if _PERM_LIST is None:
+        with _perm_lock:
+            if _PERM_LIST is None:
+                keys = array("H", (int("".join(sorted(f"{n:04d}"))) for n in range(10000)))
+                groups = {}
+                for n in range(10000):
+                    groups.setdefault(keys[n], []).append(n)
+
+                start = array("I", bytes(4 * 10000))
+                perms = array("H")
+                for k, members in groups.items():
+                    start[k] = len(perms)
+                    perms.extend(members)
+                comb = array("B", (len(groups[keys[n]]) for n in range(10000)))
+
+                _PERM_COMB, _PERM_KEY, _PERM_START = comb, keys, start
+                _PERM_LIST = perms
+    return _PERM_COMB, _PERM_KEY, _PERM_START, _PERM_LIST
+
+def _is_4d(number: str) -> bool:
+    return len(number) == 4 and number.isdigit()
+
+def combination_count(number: str) -> int:
+    """4 位号码的全排列组合数（查表）"""
+    if not _is_4d(number):
+        return _combination_count(number)
+    return _perm_tables()[0][int(number)]
+
+def perm_key(number: str) -> str:
+    """
+    排列无关的号码键：数字排序后的字符串，box/ibox 按它对奖。
+    （四个字符排序比查 _PERM_KEY 再格式化成字符串更快，所以不查表）
+    """
+    return "".join(sorted(number))
+
+def permutations_of(number: str) -> array:
+    """4 位号码的所有不重复排列（含自身，int，升序）"""
+    comb, keys, start, perms = _perm_tables()
+    k = keys[int(number)]
+    return perms[start[k]:start[k] + comb[k]]
+
+def prize_payout(market: str, bet_type: str, mode, prize: str, amount, number: str) -> float:
+    """
+    单注在单个市场中某个奖项的派彩。
+
+    - 普通：号码完全一致，赔率 × 金额
+    - box：任一排列中奖，按原下注额派彩（同 calculate 的 potential）
+    - ibox：任一排列中奖，赔率按组合数平均
+    """
+    ratio = PRIZE_RATIOS.get(bet_type, {}).get(prize)
+    if not ratio:
+        return 0.0
+    odds = STANDARD_ODDS[market][bet_type] * ratio
+    if mode == "ibox":
+        odds /= combination_count(number)
+    return round(odds * float(amount), 2)
+
+def bet_exposure(number: str, bet_type: str, mode, amount, markets) -> Iterator[tuple]:
+    """
+    单注在每个 (市场, 号码) 上的最大赔付（按头奖赔率），yield (market, number, liability)：
+      - 普通：只压在号码本身
+      - box：每个排列各下了 amount，任一排列中头奖都赔满额
+      - ibox：每个排列都可能中，赔率按组合数平均
+    """
+    numbers = [number]
+    if mode in ("box", "ibox") and _is_4d(number):
+        numbers = [f"{n:04d}" for n in permutations_of(number)]
+    for market in markets:
+        liability = STANDARD_ODDS[market][bet_type] * float(amount)
+        if mode == "ibox":
+            liability /= combination_count(number)
+        for n in numbers:
+            yield market, n, liability
+
+def build_payout_table(market: str, draw: Dict[str, List[str]]) -> Dict[str, Dict[str, array]]:
+    """
+    为一期开奖（某日某市场）预先算好每个号码的派彩向量。
+
+    draw 为 parser.parse_result_text 的结果。返回
+        {bet_type: {"": 普通, "box": ..., "ibox": ...}}
+    每个向量是 10000 个 float 的 array，下标就是 4 位号码，值为下注 RM1
+    在这一期所有奖项的派彩合计。结算任意一注只需：
+        table[bet_type][mode or ""][int(number)] * amount
+    """
+    table = {}
+    for bet_type, ratios in PRIZE_RATIOS.items():
+        straight = array("d", bytes(8 * 10000))
+        box = array("d", bytes(8 * 10000))
+        ibox = array("d", bytes(8 * 10000))
+        for prize, numbers in draw.items():
+            ratio = ratios.get(prize)
+            if not ratio:
+                continue
+            odds = STANDARD_ODDS[market][bet_type] * ratio
+            for number in numbers:
+                straight[int(number)] += odds
+                # box / ibox：中奖号码的每个排列都算中；ibox 按组合数平均
+                perms = permutations_of(number)
+                for n in perms:
+                    box[n] += odds
+                    ibox[n] += odds / len(perms)
+        table[bet_type] = {"": straight, "box": box, "ibox": ibox}
+    return table
+
 def _combination_count(number: str) -> int:
-    """计算 4 位数字的全排列组合数：4! / ∏(count(d)!)"""
+    """计算任意位数号码的全排列组合数：n! / ∏(count(d)!)（非 4 位号码时使用）"""
     cnt = Counter(number)
-    comb = math.factorial(4)
+    comb = math.factorial(len(number))
     for c in cnt.values():
         comb //= math.factorial(c)
     return comb
@@ -30,7 +166,7 @@ def _commission_rate_for_market(market: str) -> float:
     """返回单个 market 的抽水比例"""
     return COMMISSION_RATES["MKTS"] if market in ("M","K","T","S") else COMMISSION_RATES["HE"]
 
-def calculate(bets: List[Dict]) -> Dict:
+def calculate(bets: Iterable[Dict]) -> Dict:
     """
     对 parser.parse_bet_text 拆出的注单列表进行计算。
 
@@ -47,9 +183,19 @@ def calculate(bets: List[Dict]) -> Dict:
         "total_commission": ...
       }
     """
-    total_amount = 0.0
-    total_potential = 0.0
-    total_commission = 0.0
+    summary = {}
+    for _ in iter_priced(bets, summary):
+        pass
+    return summary
+
+def iter_priced(bets: Iterable[Dict], summary: Dict) -> Iterator[Dict]:
+    """
+    calculate 的流式版本：逐注计算并 yield，汇总累加进 summary。
+    可直接接 parser.iter_bet_text 和 db.insert_bets，中间不需要列表。
+    """
+    summary.setdefault("total_amount", 0.0)
+    summary.setdefault("total_potential", 0.0)
+    summary.setdefault("total_commission", 0.0)
 
     for bet in bets:
         number  = bet["number"]
@@ -59,7 +205,7 @@ def calculate(bets: List[Dict]) -> Dict:
         markets = bet["markets"]
 
         # 1. 组合数
-        comb = _combination_count(number)
+        comb = combination_count(number)
 
         # 2. 单市场扣款（stake_per_market）
         if mode == "box":
@@ -101,9 +247,9 @@ def calculate(bets: List[Dict]) -> Dict:
         )
 
         # 6. 累计到总数
-        total_amount    += bet_total_stake
-        total_potential += potential_per_market
-        total_commission+= commission
+        summary["total_amount"]     += bet_total_stake
+        summary["total_potential"]  += potential_per_market
+        summary["total_commission"] += commission
 
         # 7. 回写回 bet dict
         bet["comb"]          = comb
@@ -111,8 +257,181 @@ def calculate(bets: List[Dict]) -> Dict:
         bet["potential_win"] = bet_total_potential
         bet["commission"]    = commission
 
+        yield bet
+
+# 列式计算用的小整数编码
+BET_TYPES = ("B", "S", "A", "C")
+MODES = (None, "box", "ibox")
+
+def market_order(markets) -> int:
+    """
+    市场按书写顺序打包成一个整数，每个市场占 3 位（_MARKET_ORDER 下标 + 1，0 表示结束）：
+    ["K","M"] → 2 | 1 << 3 = 10。重复的市场照样保留，与 calculate 逐个累加一致。
+    """
+    order = 0
+    for i, m in enumerate(markets):
+        order |= (_MARKET_ORDER.index(m) + 1) << (3 * i)
+    return order
+
+def to_columns(bets: List[Dict]) -> Dict:
+    """注单 dict 列表 → calculate_columns 的列式输入（numpy 数组）；mode 为 '' 或 None 都算普通"""
+    import numpy as np
+
+    return {
+        "numbers": np.fromiter((int(b["number"]) for b in bets), dtype=np.int16, count=len(bets)),
+        "types":   np.fromiter((BET_TYPES.index(b["type"]) for b in bets), dtype=np.int8, count=len(bets)),
+        "modes":   np.fromiter((MODES.index(b.get("mode") or None) for b in bets), dtype=np.int8, count=len(bets)),
+        "markets": np.fromiter((market_mask(b["markets"]) for b in bets), dtype=np.int8, count=len(bets)),
+        "amounts": np.fromiter((b["amount"] for b in bets), dtype=np.int64, count=len(bets)),
+        "orders":  np.fromiter((market_order(b["markets"]) for b in bets), dtype=np.int64, count=len(bets)),
+    }
+
+def calculate_columns(numbers, types, modes, markets, amounts, orders=None) -> Dict:
+    """
+    calculate 的列式版本：一次向量化算完整批注单，用于批量重新计价。
+
+    参数都是等长数组：
+      numbers  号码（int，0–9999）
+      types    BET_TYPES 下标
+      modes    MODES 下标（0 普通 / 1 box / 2 ibox）
+      markets  市场位掩码（parser.MARKET_BITS）
+      amounts  下注金额
+      orders   可选，市场书写顺序（market_order）；不传时按 MARKET_BITS 顺序
+
+    返回 comb / stake / potential_win / commission 四个数组以及与 calculate
+    相同的三个汇总。传入 orders 时佣金按书写顺序逐个市场累加，结果与 calculate 完全一致。
+    """
+    import numpy as np
+
+    numbers = np.asarray(numbers, dtype=np.intp)
+    types = np.asarray(types, dtype=np.intp)
+    modes = np.asarray(modes)
+    markets = np.asarray(markets, dtype=np.int64)
+    amounts = np.asarray(amounts)
+
+    # 1. 组合数（查排列表）
+    comb = np.frombuffer(_perm_tables()[0], dtype=np.uint8).astype(np.int64)[numbers]
+
+    # 2. 单市场扣款
+    is_box = modes == MODES.index("box")
+    is_ibox = modes == MODES.index("ibox")
+    stake = np.where(is_box, amounts * comb, amounts)
+
+    # 3. 单市场最大可赢：有 H 用 H 的赔率，否则有 E 用 E，否则用 M
+    odds_by_market = np.array(
+        [[STANDARD_ODDS[m][t] for t in BET_TYPES] for m in ("M", "H", "E")], dtype=np.float64
+    )
+    odds_row = np.where(
+        markets & MARKET_BITS["H"], 1, np.where(markets & MARKET_BITS["E"], 2, 0)
+    )
+    std_odds = odds_by_market[odds_row, types]
+    potential = np.where(
+        is_ibox, std_odds / comb * amounts,
+        np.where(is_box, std_odds * amounts, std_odds * stake),
+    )
+
+    # 4. 多市场：按书写顺序逐个取出市场下标（0 为已取完）
+    if orders is None:
+        orders = np.zeros(len(markets), dtype=np.int64)
+        for m in reversed(_MARKET_ORDER):
+            on = (markets & MARKET_BITS[m]) != 0
+            orders = np.where(on, orders << 3 | (_MARKET_ORDER.index(m) + 1), orders)
+    orders = np.asarray(orders, dtype=np.int64)
+    rates = np.array([0.0] + [_commission_rate_for_market(m) for m in _MARKET_ORDER], dtype=np.float64)
+    n_markets = np.zeros(len(markets), dtype=np.int64)
+    commission = np.zeros(len(markets), dtype=np.float64)
+    while orders.any():
+        idx = orders & 7
+        on = idx != 0
+        n_markets += on
+        # 5. 佣金与 calculate 一样逐个市场累加（加 0.0 不改变数值）
+        commission = commission + np.where(on, stake * rates[idx], 0.0)
+        orders = orders >> 3
+
+    total_stake = stake * n_markets
+    potential_win = potential * n_markets
+
+    def running_total(values):
+        # cumsum 按顺序逐个累加，与 calculate 里的 += 完全一致
+        return float(np.cumsum(values, dtype=np.float64)[-1]) if len(values) else 0.0
+
     return {
-        "total_amount":     total_amount,
-        "total_potential":  total_potential,
-        "total_commission": total_commission,
+        "comb": comb,
+        "stake": stake,
+        "potential_win": potential_win,
+        "commission": commission,
+        "total_amount": running_total(total_stake),
+        "total_potential": running_total(potential),
+        "total_commission": running_total(commission),
     }
+
+# ---------- 本地测试 ----------
+if __name__ == "__main__":
+    draw = {
+        "1st": ["1234"], "2nd": ["5678"], "3rd": ["1122"],
+        "special": ["1234", "0007"], "consolation": ["9999"],
+    }
+    table = build_payout_table("M", draw)
+
+    def lookup(number, bet_type, mode=None, amount=1):
+        return round(table[bet_type][mode or ""][int(number)] * amount, 2)
+
+    # 普通：B 中头奖 + 特别奖两次，S 不中特别奖，A 只中头奖，C 中二奖
+    assert lookup("1234", "B") == 2750 + 198
+    assert lookup("1234", "S") == 3850
+    assert lookup("5678", "A") == 0
+    assert lookup("5678", "C") == 242
+    assert lookup("0007", "S") == 0
+    assert lookup("9999", "B", amount=5) == 66 * 5
+    assert lookup("4321", "B") == 0
+    # box：任一排列按原金额；ibox：按组合数平均
+    assert lookup("4321", "B", "box") == 2750 + 198
+    assert lookup("2211", "S", "box") == round(3850 * 2 / 7, 2)
+    assert lookup("4321", "B", "ibox") == round((2750 + 198) / 24, 2)
+    assert lookup("7000", "B", "ibox") == round(198 / 4, 2)
+
+    # 与逐奖项计算的 prize_payout 一致
+    for bet_type in PRIZE_RATIOS:
+        for mode in (None, "box", "ibox"):
+            for number in ("1234", "4321", "5678", "8765", "1212", "0070", "9999", "0000"):
+                expected = sum(
+                    prize_payout("M", bet_type, mode, prize, 3, number)
+                    for prize, numbers in draw.items()
+                    for won in numbers
+                    if (won == number if mode is None else perm_key(won) == perm_key(number))
+                )
+                assert abs(lookup(number, bet_type, mode, 3) - expected) < 0.02, (bet_type, mode, number)
+    print("派彩向量测试通过")
+
+    # 排列表与逐个计算一致
+    from itertools import permutations
+    for n in range(10000):
+        number = f"{n:04d}"
+        expected = sorted({int("".join(p)) for p in permutations(number)})
+        assert list(permutations_of(number)) == expected, number
+        assert combination_count(number) == len(expected) == _combination_count(number)
+        assert f"{_perm_tables()[1][n]:04d}" == perm_key(number)
+    print("排列表测试通过")
+
+    # 列式计算与逐注计算完全一致（数据库读出的普通注单 mode 为 ''；市场可能重复）
+    import random
+    rng = random.Random(11)
+    bets = []
+    for _ in range(20000):
+        mode = rng.choice(MODES + ("",))
+        bets.append({
+            "number": f"{rng.randrange(10000):04d}",
+            "type": rng.choice(("B", "S") if mode else BET_TYPES),
+            "mode": mode,
+            "amount": rng.randint(1, 50),
+            "markets": rng.sample(_MARKET_ORDER, rng.randint(1, 6)),
+        })
+    bets.append({"number": "1234", "type": "B", "mode": None, "amount": 3, "markets": ["K", "M", "K"]})
+    summary = calculate(bets)
+    cols = calculate_columns(**to_columns(bets))
+    for i, bet in enumerate(bets):
+        for field in ("comb", "stake", "potential_win", "commission"):
+            assert bet[field] == cols[field][i], (field, bet, cols[field][i])
+    for field, value in summary.items():
+        assert value == cols[field], (field, value, cols[field])
+    print("列式计算测试通过")
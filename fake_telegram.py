@@ -0,0 +1,220 @@
+# fake_telegram.py
+#
+# 本地假 Telegram：一个只实现了机器人用到的几个方法的 Bot API 服务（tornado），
+# 用来在没有网络 / 没有真实 token 的情况下端到端跑 bot.py 的 handler：
+#
+#   python fake_telegram.py [条数]
+#
+# 分别以 polling（假 getUpdates 下发）和 webhook（向 bot 的 webhook POST）两种模式
+# 发送同样的下注消息，记录从发出更新到 bot 调用 sendMessage 回复的端到端延迟。
+
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+import tornado.web
+
+FAKE_TOKEN = "123456:FAKE"
+FAKE_BOT = {"id": 123456, "is_bot": True, "first_name": "4D", "username": "fake_4d_bot"}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _params(request):
+    """Bot API 参数：JSON 请求体，或表单（PTB 把非字符串的值 JSON 编码后放进表单）"""
+    if request.headers.get("Content-Type", "").startswith("application/json"):
+        return json.loads(request.body or b"{}")
+    params = {}
+    for key, values in request.body_arguments.items():
+        value = values[-1].decode()
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+class FakeBotAPI:
+    """
+    假 Bot API：
+      - 待下发的更新放在 self.updates，getUpdates 长轮询取走
+      - bot 发出的消息记在 self.sent，并唤醒等待该 chat 回复的协程
+    """
+
+    def __init__(self):
+        self.port = free_port()
+        self.updates = []
+        self.sent = []
+        self.webhook = None
+        self._update_id = 0
+        self._message_id = 0
+        self._new_update = asyncio.Event()
+        self._reply_waiters = {}
+        self._server = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def start(self):
+        api = self
+
+        class Handler(tornado.web.RequestHandler):
+            async def post(self, token, method):
+                result = await api.call(method, _params(self.request))
+                self.set_header("Content-Type", "application/json")
+                self.write(json.dumps({"ok": True, "result": result}))
+
+            get = post
+
+        app = tornado.web.Application([(r"/bot([^/]+)/(\w+)", Handler)])
+        self._server = app.listen(self.port, address="127.0.0.1")
+
+    def stop(self):
+        # 放行还挂着的 getUpdates 长轮询
+        self._new_update.set()
+        if self._server is not None:
+            self._server.stop()
+
+    async def call(self, method, params):
+        if method == "getMe":
+            return FAKE_BOT
+        if method == "setWebhook":
+            self.webhook = params
+            return True
+        if method in ("deleteWebhook", "answerCallbackQuery", "editMessageReplyMarkup", "close", "logOut"):
+            return True
+        if method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            if not self.updates:
+                self._new_update.clear()
+                try:
+                    await asyncio.wait_for(self._new_update.wait(), float(params.get("timeout") or 0))
+                except asyncio.TimeoutError:
+                    pass
+            return self.updates
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id") or 0)
+            self.sent.append((time.perf_counter(), chat_id, params.get("text")))
+            waiter = self._reply_waiters.pop(chat_id, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(time.perf_counter())
+            self._message_id += 1
+            return {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group", "title": "fake"},
+                "from": FAKE_BOT,
+                "text": params.get("text", ""),
+            }
+        raise tornado.web.HTTPError(404, f"fake Bot API 未实现 {method}")
+
+    def make_update(self, chat_id, text, user_id=1):
+        """群消息更新（与 Telegram 推送的 JSON 结构一致）"""
+        self._update_id += 1
+        self._message_id += 1
+        return {
+            "update_id": self._update_id,
+            "message": {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group", "title": f"group {chat_id}"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "agent"},
+                "text": text,
+            },
+        }
+
+    def expect_reply(self, chat_id):
+        """返回一个 future，bot 下次向 chat_id 发消息时完成（值为 perf_counter 时间）"""
+        fut = asyncio.get_running_loop().create_future()
+        self._reply_waiters[chat_id] = fut
+        return fut
+
+    def push_update(self, update):
+        """polling 模式：放进 getUpdates 队列"""
+        self.updates.append(update)
+        self._new_update.set()
+
+
+async def post_webhook(client, url, update, secret):
+    return await client.post(
+        url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret}
+    )
+
+
+async def measure(mode, n, text="08/06\nMKT\n1234-1B 1S"):
+    """以 mode（polling / webhook）启动 bot，逐条发送 n 条下注消息，返回每条的延迟（秒）"""
+    import httpx
+    import bot
+
+    api = FakeBotAPI()
+    api.start()
+    app = bot.build_app(FAKE_TOKEN, base_url=api.base_url)
+    await app.initialize()
+
+    secret = "fake-secret"
+    opts = bot.webhook_options()
+    opts.update(listen="127.0.0.1", port=free_port(), webhook_url=None, secret_token=secret)
+    url = f"http://127.0.0.1:{opts['port']}/{opts['url_path']}"
+
+    if mode == "webhook":
+        await app.updater.start_webhook(**opts)
+    else:
+        await app.updater.start_polling(poll_interval=0, timeout=10)
+    await app.start()
+
+    latencies = []
+    try:
+        async with httpx.AsyncClient() as client:
+            if mode == "webhook":
+                # 错误的 secret 必须被拒绝
+                bad = await post_webhook(client, url, api.make_update(-1, text), "wrong")
+                assert bad.status_code == 403, f"secret 校验失败：{bad.status_code}"
+
+            for i in range(n):
+                chat_id = -1000 - i
+                update = api.make_update(chat_id, text)
+                reply = api.expect_reply(chat_id)
+                start = time.perf_counter()
+                if mode == "webhook":
+                    resp = await post_webhook(client, url, update, secret)
+                    assert resp.status_code == 200, resp.status_code
+                else:
+                    api.push_update(update)
+                latencies.append(await asyncio.wait_for(reply, 10) - start)
+    finally:
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        api.stop()
+    return latencies
+
+
+def _summary(latencies):
+    ms = sorted(x * 1000 for x in latencies)
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    return f"p50 {statistics.median(ms):.2f} ms  p95 {p95:.2f} ms  max {ms[-1]:.2f} ms"
+
+
+# ---------- 本地测试 ----------
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    tmp = tempfile.mkdtemp(prefix="4d-fake-tg-")
+    os.environ.setdefault("SQLITE_PATH", os.path.join(tmp, "fake.db"))
+
+    async def main():
+        for mode in ("polling", "webhook"):
+            latencies = await measure(mode, n)
+            print(f"{mode:8s} {n} 条下注消息：{_summary(latencies)}")
+
+    asyncio.run(main())
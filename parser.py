@@ -2,11 +2,84 @@
 
 import re
 from datetime import datetime
-from typing import List, Dict
+from typing import Dict, Iterator, List, Optional, Tuple
 
 # 支持的 market code
 VALID_MARKETS = {"M", "K", "T", "S", "H", "E"}
 
+# market → 位掩码（数据库 bets.market_mask 按位存储所下的市场）
+MARKET_BITS = {"M": 1, "K": 2, "T": 4, "S": 8, "H": 16, "E": 32}
+
+def market_mask(markets) -> int:
+    """["M","K","T"] → 7"""
+    mask = 0
+    for m in markets:
+        mask |= MARKET_BITS[m]
+    return mask
+
+def markets_from_mask(mask: int) -> List[str]:
+    """7 → ["M","K","T"]（按 MARKET_BITS 顺序）"""
+    return [m for m, bit in MARKET_BITS.items() if mask & bit]
+
+# 开奖成绩的奖项（按奖级从高到低）
+PRIZE_TIERS = ("1st", "2nd", "3rd", "special", "consolation")
+
+def parse_result_text(text: str) -> Dict[str, List[str]]:
+    """
+    解析管理员输入 / results.result_text 中的开奖成绩。
+
+        1st: 1234
+        2nd: 5678
+        3rd: 9012
+        Special: 1111 2222 ...
+        Consolation: 3333 4444 ...
+
+    返回 {"1st": ["1234"], ..., "special": [...], "consolation": [...]}
+    """
+    draw = {tier: [] for tier in PRIZE_TIERS}
+    for line in text.splitlines():
+        if ":" not in line:
+            continue
+        key, val = line.split(":", 1)
+        key = key.strip().lower()
+        if key in draw:
+            draw[key] = val.split()
+    return draw
+
+# 每个奖项的号码个数：头奖 / 二奖 / 三奖各一个，特别奖 / 安慰奖最多各十个
+PRIZE_TIER_SIZES = {"1st": 1, "2nd": 1, "3rd": 1, "special": 10, "consolation": 10}
+
+_DRAW_NUMBER_RE = re.compile(r"[0-9]{4}")
+
+def parse_result_input(text: str) -> Dict[str, List[str]]:
+    """
+    解析并校验管理员输入的开奖成绩（格式同 parse_result_text），不合格抛 ValueError：
+      - 每个非空行都是「奖项: 号码 ...」，奖项为 PRIZE_TIERS 之一
+      - 号码都是 4 位数字；头奖 / 二奖 / 三奖各恰好一个，特别奖 / 安慰奖最多各 10 个
+    """
+    for line in text.splitlines():
+        if line.strip() and line.split(":", 1)[0].strip().lower() not in PRIZE_TIER_SIZES:
+            raise ValueError(f"无法识别的行：{line.strip()}")
+
+    draw = parse_result_text(text)
+    for tier, size in PRIZE_TIER_SIZES.items():
+        numbers = draw[tier]
+        bad = [n for n in numbers if not _DRAW_NUMBER_RE.fullmatch(n)]
+        if bad:
+            raise ValueError(f"{tier} 的号码必须是 4 位数字：{' '.join(bad)}")
+        if size == 1 and len(numbers) != 1:
+            raise ValueError(f"{tier} 需要恰好 1 个号码")
+        if len(numbers) > size:
+            raise ValueError(f"{tier} 最多 {size} 个号码")
+    return draw
+
+def format_result_text(draw: Dict[str, List[str]]) -> str:
+    """parse_result_text 的逆操作：格式化为统一的 result_text"""
+    return "\n".join(
+        f"{tier if tier[0].isdigit() else tier.capitalize()}: {' '.join(draw.get(tier, []))}"
+        for tier in PRIZE_TIERS
+    )
+
 def parse_bet_text(text: str, default_year: int = 2025) -> List[Dict]:
     """
     将下注文本拆成多笔注单。
@@ -53,78 +126,150 @@ def parse_bet_text(text: str, default_year: int = 2025) -> List[Dict]:
       }
     ]
     """
-    # 1. 分行并去除空行
-    lines = [line.strip() for line in text.splitlines() if line.strip()]
-    if len(lines) < 3:
-        raise ValueError("格式错误：至少需要日期、市场行、下注行")
+    return list(iter_bet_text(text, default_year))
+
+# 预编译的日期行文法 DD/MM，以及计算 token 列号用的空白分词
+_DATE_RE = re.compile(r"(\d{1,2})/(\d{1,2})")
+_TOKEN_RE = re.compile(r"\S+")
+
+# 下注类型（大小写均可）
+_BET_TYPES = {"B": "B", "S": "S", "A": "A", "C": "C", "b": "B", "s": "S", "a": "A", "c": "C"}
+
+def _scan_bet_token(tok: str):
+    """
+    单遍识别一个下注 token，返回 (号码 or None, 金额, 类型)；无法识别时类型为 None。
+
+      "1526-1B" → ("1526", 1, "B")    号码 1–4 位，补零到 4 位
+      "1S"      → (None, 1, "S")       沿用前一个号码
+
+    只用字符串切片和 isdecimal()（与正则 \d 同义），比逐个 token 跑正则快得多。
+    """
+    bet_type = _BET_TYPES.get(tok[-1])
+    if bet_type is None:
+        return None, None, None
+    number, sep, amount = tok[:-1].partition("-")
+    if not sep:
+        number, amount = None, number
+    elif not (0 < len(number) <= 4 and number.isdecimal()):
+        return None, None, None
+    if not amount.isdecimal():
+        return None, None, None
+    if number is not None and len(number) < 4:
+        number = number.zfill(4)
+    return number, int(amount), bet_type
 
-    # 2. 解析日期
-    date_match = re.match(r"^(\d{1,2})/(\d{1,2})$", lines[0])
+def _parse_date_line(line: str, default_year: int):
+    date_match = _DATE_RE.fullmatch(line)
     if not date_match:
-        raise ValueError(f"无效日期格式：{lines[0]}")
+        return None
     day, month = map(int, date_match.groups())
-    date_obj = datetime(default_year, month, day)
-    date_str = date_obj.strftime("%Y-%m-%d")
+    return datetime(default_year, month, day).strftime("%Y-%m-%d")
 
-    # 3. 解析市场代码
-    market_line = lines[1].replace(" ", "").upper()
+def _parse_market_line(line: str) -> List[str]:
+    market_line = line.replace(" ", "").upper()
     markets = [c for c in market_line if c in VALID_MARKETS]
     if not markets:
-        raise ValueError(f"未识别任何有效市场代码：{lines[1]}")
+        raise ValueError(f"未识别任何有效市场代码：{line}")
+    return markets
 
-    # 4. 遍历下注行，拆出每笔注单
-    bets: List[Dict] = []
-    for line in lines[2:]:
+def _is_market_line(line: str) -> bool:
+    """只由市场代码（和空格）组成的行，例如 "MKT" / "h e" """
+    letters = line.replace(" ", "").upper()
+    return bool(letters) and all(c in VALID_MARKETS for c in letters)
+
+def iter_bet_text(
+    text: str,
+    default_year: int = 2025,
+    unparsed: Optional[List[Tuple[int, int, str]]] = None,
+) -> Iterator[Dict]:
+    """
+    parse_bet_text 的流式版本：逐行解析，边解析边 yield 注单。
+
+    一条消息可以包含多个区块，每个区块以 DD/MM 日期行开头、下一行为市场行；
+    区块内也可以再写一行市场代码切换市场：
+
+        08/06
+        MKT
+        1526-1B 1S ibox
+        HE
+        1234-2C
+        09/06
+        M
+        5678-1B
+
+    无法识别的 token 不再静默丢弃：传入 unparsed 列表时，会追加
+    (行号, 列号, token)，行号 / 列号从 1 开始，对应原始文本。
+    """
+    lines = [(no, line) for no, line in enumerate(text.splitlines(), start=1) if line.strip()]
+    if len(lines) < 3:
+        raise ValueError("格式错误：至少需要日期、市场行、下注行")
+
+    date_str = None
+    markets = None
+    expect_markets = False
+
+    for line_no, raw in lines:
+        line = raw.strip()
+
+        # 1. 日期行：开始新区块，下一行必须是市场行（不含 "/" 的行不用再匹配）
+        if "/" in line:
+            new_date = _parse_date_line(line, default_year)
+            if new_date is not None:
+                date_str = new_date
+                expect_markets = True
+                continue
+        if date_str is None:
+            raise ValueError(f"无效日期格式：{line}")
+
+        # 2. 市场行（以数字开头的一定是下注行）
+        if expect_markets or (not line[0].isdigit() and _is_market_line(line)):
+            markets = _parse_market_line(line)
+            expect_markets = False
+            continue
+
+        # 3. 下注行，逐个 token 单遍扫描拆出每笔注单
         tokens = line.split()
         # 检查是否有特殊模式 ibox/box
         mode = None
         if tokens[-1].lower() in ("ibox", "box"):
             mode = tokens[-1].lower()
-            tokens = tokens[:-1]
+            tokens.pop()
 
         current_number = None
+        bad_tokens = None
         for tok in tokens:
-            # 格式：号码-金额类型，例如 "1526-1B"
-            m_full = re.match(r"^(\d{1,4})-(\d+)([BSAC])$", tok, re.IGNORECASE)
-            if m_full:
-                num, amt, t = m_full.groups()
-
-                if mode and t.upper() not in ("B", "S"):
-                    raise ValueError(f"模式“{mode}”只能用于 B/S 类型下注，无法用于 {t.upper()}。")
-
-                current_number = num.zfill(4)
-                bets.append({
-                    "date": date_str,
-                    "markets": markets,
-                    "number": current_number,
-                    "type": t.upper(),
-                    "mode": mode,
-                    "amount": int(amt)
-                })
-                continue
+            number, amount, bet_type = _scan_bet_token(tok)
 
-            # 格式：金额类型，例如 "1S"
-            m_part = re.match(r"^(\d+)([BSAC])$", tok, re.IGNORECASE)
-            if m_part:
-                if current_number is None:
-                    raise ValueError(f"未指定号码，无法解析：{tok}")
-                amt, t = m_part.groups()
-                if mode and t.upper() not in ("B", "S"):
-                    raise ValueError(f"模式“{mode}”只能用于 B/S 类型下注，无法用于 {t.upper()}。")
-                bets.append({
-                    "date": date_str,
-                    "markets": markets,
-                    "number": current_number,
-                    "type": t.upper(),
-                    "mode": mode,
-                    "amount": int(amt)
-                })
+            # 无法识别的 token：稍后统一算出列号
+            if bet_type is None:
+                if unparsed is not None:
+                    bad_tokens = (bad_tokens or 0) + 1
                 continue
 
-            # 跳过无法识别的 token
-            # raise ValueError(f"无法解析的 token：{tok}")
+            # "1526-1B" 带号码；"1S" 沿用前一个号码
+            if number is not None:
+                current_number = number
+            elif current_number is None:
+                raise ValueError(f"未指定号码，无法解析：{tok}")
+            if mode and bet_type not in ("B", "S"):
+                raise ValueError(f"模式“{mode}”只能用于 B/S 类型下注，无法用于 {bet_type}。")
+
+            yield {
+                "date": date_str,
+                "markets": markets,
+                "number": current_number,
+                "type": bet_type,
+                "mode": mode,
+                "amount": amount
+            }
 
-    return bets
+        if bad_tokens:
+            matches = list(_TOKEN_RE.finditer(raw))
+            if mode:
+                matches.pop()
+            for m in matches:
+                if _scan_bet_token(m.group())[2] is None:
+                    unparsed.append((line_no, m.start() + 1, m.group()))
 
 # ---------- 本地测试 ----------
 if __name__ == "__main__":
@@ -138,11 +283,24 @@ MKT
 09/06
 MS
 1234-2C box 5A
+""",
+        """\
+08/06
+MKT
+1526-1B 1S ibox
+HE
+1234-2C ??
+09/06
+M
+5678-1B
 """
     ]
     for txt in samples:
         print("输入：")
         print(txt)
         print("输出：")
-        print(parse_bet_text(txt))
+        unparsed = []
+        print(list(iter_bet_text(txt, unparsed=unparsed)))
+        if unparsed:
+            print("无法识别：", unparsed)
         print("-" * 30)
@@ -0,0 +1,158 @@
+# pending.py
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from db import purge_pending_slips, put_pending_slip, take_pending_slip
+
+# ✅ 待确认注单：handle_bet_text 计价后存入，handle_confirm_bet 按 (群, 注单消息, 用户) 取出。
+#   memory：进程内 LRU（单进程部署）
+#   db：存 pending_slips 表，多个 worker 进程共用，重启不丢
+PENDING_STORE = os.getenv("PENDING_STORE", "memory")
+PENDING_TTL = float(os.getenv("PENDING_TTL", "1800"))                 # 未确认的注单保留秒数
+PENDING_MAX_ENTRIES = int(os.getenv("PENDING_MAX_ENTRIES", "10000"))  # 最多保留的待确认注单数
+PENDING_MAX_BETS = int(os.getenv("PENDING_MAX_BETS", "5000"))         # 单张注单最多笔数
+
+# 每 PENDING_PURGE_EVERY 次写入清理一次过期条目（db 后端）
+PENDING_PURGE_EVERY = 100
+
+
+class PendingSlipTooLarge(ValueError):
+    pass
+
+
+class MemoryPendingStore:
+    """进程内存储：OrderedDict 按写入顺序，超过条数上限时淘汰最早的"""
+
+    def __init__(self, ttl=PENDING_TTL, max_entries=PENDING_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"puts": 0, "hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, key, bets):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, bets)
+            self.stats["puts"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def take(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            expires_at, bets = entry
+            if expires_at <= time.time():
+                self.stats["expired"] += 1
+                return None
+            self.stats["hits"] += 1
+            return bets
+
+
+class TablePendingStore:
+    """共享存储：pending_slips 表（SQLite / Postgres），注单以 JSON 保存"""
+
+    def __init__(self, ttl=PENDING_TTL, max_entries=PENDING_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"puts": 0, "hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+        self._lock = threading.Lock()
+
+    def put(self, key, bets):
+        put_pending_slip(*key, json.dumps(bets, ensure_ascii=False), time.time() + self.ttl)
+        with self._lock:
+            self.stats["puts"] += 1
+            purge = self.stats["puts"] % PENDING_PURGE_EVERY == 0
+        if purge:
+            evicted = purge_pending_slips(time.time(), self.max_entries)
+            with self._lock:
+                self.stats["evictions"] += evicted
+
+    def take(self, key):
+        row = take_pending_slip(*key)
+        with self._lock:
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            payload, expires_at = row
+            if expires_at <= time.time():
+                self.stats["expired"] += 1
+                return None
+            self.stats["hits"] += 1
+        return json.loads(payload)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_pending_store():
+    """按 PENDING_STORE 创建（一次）并返回待确认注单存储"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if PENDING_STORE == "db":
+                    _store = TablePendingStore()
+                elif PENDING_STORE == "memory":
+                    _store = MemoryPendingStore()
+                else:
+                    raise ValueError(f"未知的 PENDING_STORE：{PENDING_STORE}")
+    return _store
+
+def put_pending(chat_id, message_id, user_id, bets):
+    """保存一张待确认注单；超过 PENDING_MAX_BETS 笔抛出 PendingSlipTooLarge"""
+    if len(bets) > PENDING_MAX_BETS:
+        raise PendingSlipTooLarge(f"单张注单最多 {PENDING_MAX_BETS} 笔，当前 {len(bets)} 笔")
+    get_pending_store().put((chat_id, message_id, user_id), bets)
+
+def take_pending(chat_id, message_id, user_id):
+    """取出并删除一张待确认注单（只有一个确认能拿到）；不存在或已过期返回 None"""
+    return get_pending_store().take((chat_id, message_id, user_id))
+
+def pending_stats():
+    store = get_pending_store()
+    return dict(store.stats, backend=PENDING_STORE)
+
+
+# ---------- 本地测试 ----------
+if __name__ == "__main__":
+    import tempfile
+
+    import db
+
+    # SQLite 下用临时库，不碰 data.db
+    db.SQLITE_PATH = os.path.join(tempfile.mkdtemp(prefix="4d-pending-"), "pending.db")
+    db.init_db()
+    bets = [{"date": "2025-06-08", "markets": ["M", "K"], "number": "1234", "type": "B",
+             "mode": None, "amount": 1, "comb": 1, "stake": 1, "potential_win": 5500.0, "commission": 0.52}]
+
+    for store in (MemoryPendingStore(ttl=60, max_entries=3), TablePendingStore(ttl=60, max_entries=3)):
+        name = type(store).__name__
+        store.put((-1, 10, 7), bets)
+        assert store.take((-1, 10, 8)) is None, "别人的注单不能确认"
+        assert store.take((-1, 10, 7)) == bets
+        assert store.take((-1, 10, 7)) is None, "同一张注单只能确认一次"
+
+        # 过期
+        store.ttl = -1
+        store.put((-1, 11, 7), bets)
+        assert store.take((-1, 11, 7)) is None
+        store.ttl = 60
+        print(f"{name} 自测通过：{store.stats}")
+
+    # 条数上限：表存储在清理时只保留最晚过期的 max_entries 条
+    table = TablePendingStore(ttl=60, max_entries=3)
+    for i in range(5):
+        table.put((-2, i, 7), bets)
+    assert purge_pending_slips(time.time(), 3) == 2
+    assert table.take((-2, 0, 7)) is None and table.take((-2, 4, 7)) == bets
+    print("条数上限自测通过")
+    db.close_pool()
@@ -0,0 +1,350 @@
+# supervisor.py
+#
+# 多进程运行：调度进程接收更新（BOT_MODE=polling / webhook，配置与 bot.py 相同），
+# 按群（chat id）的 rendezvous 哈希转发给 BOT_WORKERS 个 worker 进程；
+# 每个 worker 跑 bot.build_app 的同一套 handler，只处理分给自己的群。
+#
+#   BOT_WORKERS=4 python supervisor.py
+#   python supervisor.py --fake [每轮条数]     # 本地用假 Telegram 跑一遍（含扩容）
+#
+# 运行中 SIGUSR1 增加一个 worker，SIGUSR2 减少一个：先等所有 worker 处理完已转发的更新，
+# 再增减进程，换了 worker 的群不会在新旧两个进程里同时处理。
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+
+logger = logging.getLogger(__name__)
+
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", str(os.cpu_count() or 1)))
+WORKER_CHECK_INTERVAL = float(os.getenv("WORKER_CHECK_INTERVAL", "1"))   # 检查 worker 存活的间隔（秒）
+
+
+# ---------- 分片 ----------
+
+def _weight(worker, key):
+    digest = hashlib.blake2b(f"{worker}:{key}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def owner(key, workers):
+    """
+    rendezvous 哈希：key 归权重最大的 worker。
+    worker 数从 N 变成 N+1 时只有约 1/(N+1) 的群换到新 worker，其余不动
+    """
+    return max(range(workers), key=lambda w: _weight(w, key))
+
+
+def shard_key(update):
+    """按聊天分片：同一个群的消息和按钮回调总在同一个 worker 里按顺序处理"""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.update_id
+
+
+# ---------- worker 进程 ----------
+
+def _worker_main(index, token, base_url, inbox, outbox):
+    # Ctrl-C / SIGTERM 由调度进程统一处理：它会发 stop，worker 处理完手上的更新再退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_run_worker(index, token, base_url, inbox, outbox))
+
+
+async def _run_worker(index, token, base_url, inbox, outbox):
+    import bot
+
+    app = bot.build_app(token, base_url=base_url, updater=False)
+    await app.initialize()
+    await app.start()
+    loop = asyncio.get_running_loop()
+    handled = 0
+    try:
+        while True:
+            kind, payload = await loop.run_in_executor(None, inbox.get)
+            if kind == "update":
+                await app.update_queue.put(Update.de_json(payload, app.bot))
+                handled += 1
+            elif kind == "drain":
+                # update_queue.join()：已放进来的更新全部处理完
+                await app.update_queue.join()
+                outbox.put(("drained", index, payload))
+            elif kind == "stop":
+                await app.update_queue.join()
+                break
+    finally:
+        stats = dict(app.update_processor.stats(), handled=handled, pid=os.getpid())
+        await app.stop()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        await app.shutdown()
+        outbox.put(("stopped", index, stats))
+
+
+# ---------- 调度 ----------
+
+class Supervisor:
+    """
+    管理 worker 进程并转发更新：
+      - 每个 worker 一个收件队列（进程重启后沿用，未处理的更新不丢）
+      - worker 意外退出时按原编号重启
+      - resize() 先排空再增减 worker
+    """
+
+    def __init__(self, token, base_url=None):
+        self.token = token
+        self.base_url = base_url
+        self.workers = 0
+        self.routed = Counter()        # worker 编号 → 转发的更新数
+        self.worker_stats = {}         # worker 编号 → 退出时上报的统计
+        self._ctx = multiprocessing.get_context("spawn")
+        self._outbox = self._ctx.Queue()
+        self._inboxes = {}
+        self._procs = {}
+        self._routing = asyncio.Lock()
+        self._drain_seq = 0
+        self._drain_waiters = {}
+        self._stopped = {}
+        self._tasks = []
+
+    def _spawn(self, index):
+        inbox = self._inboxes.setdefault(index, self._ctx.Queue())
+        proc = self._ctx.Process(
+            target=_worker_main,
+            args=(index, self.token, self.base_url, inbox, self._outbox),
+            name=f"4d-worker-{index}",
+            daemon=True,
+        )
+        proc.start()
+        self._procs[index] = proc
+        logger.info(f"worker {index} 已启动（pid {proc.pid}）")
+
+    async def start(self, workers):
+        import bot  # noqa: F401  导入时执行数据库迁移，先在调度进程里做完再起 worker
+
+        self._tasks = [
+            asyncio.create_task(self._read_outbox()),
+            asyncio.create_task(self._watch_workers()),
+        ]
+        await self.resize(workers)
+
+    async def _read_outbox(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            kind, index, payload = await loop.run_in_executor(None, self._outbox.get)
+            if kind == "closed":
+                return
+            if kind == "drained":
+                waiter = self._drain_waiters.get((index, payload))
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(None)
+            elif kind == "stopped":
+                self.worker_stats[index] = payload
+                waiter = self._stopped.get(index)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(payload)
+
+    async def _watch_workers(self):
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for index, proc in list(self._procs.items()):
+                if index not in self._stopped and not proc.is_alive():
+                    logger.error(f"worker {index} 意外退出（exitcode {proc.exitcode}），重启")
+                    self._spawn(index)
+
+    async def route(self, update):
+        """把更新转给负责该群的 worker"""
+        async with self._routing:
+            index = owner(shard_key(update), self.workers)
+            self._inboxes[index].put(("update", update.to_dict()))
+            self.routed[index] += 1
+
+    async def dispatch(self, update_queue):
+        """从 Updater 的队列取更新逐条转发，直到被取消"""
+        while True:
+            update = await update_queue.get()
+            try:
+                await self.route(update)
+            finally:
+                update_queue.task_done()
+
+    async def drain(self):
+        """等所有 worker 处理完目前已转发的更新"""
+        self._drain_seq += 1
+        loop = asyncio.get_running_loop()
+        waiters = []
+        for index in range(self.workers):
+            waiter = loop.create_future()
+            self._drain_waiters[(index, self._drain_seq)] = waiter
+            self._inboxes[index].put(("drain", self._drain_seq))
+            waiters.append(waiter)
+        try:
+            await asyncio.gather(*waiters)
+        finally:
+            for index in range(self.workers):
+                self._drain_waiters.pop((index, self._drain_seq), None)
+
+    async def _stop_worker(self, index):
+        waiter = self._stopped[index] = asyncio.get_running_loop().create_future()
+        self._inboxes[index].put(("stop", None))
+        stats = await waiter
+        await asyncio.get_running_loop().run_in_executor(None, self._procs[index].join)
+        del self._procs[index], self._stopped[index]
+        logger.info(f"worker {index} 已停止：{stats}")
+
+    async def resize(self, workers):
+        """
+        调整 worker 数。转发暂停，先排空所有 worker，再停掉多出的 / 启动新增的，
+        之后按新的 worker 数分片；同一个群不会同时在两个进程里处理。
+        """
+        workers = max(1, workers)
+        async with self._routing:
+            if self.workers:
+                await self.drain()
+            await asyncio.gather(*(self._stop_worker(i) for i in range(workers, self.workers)))
+            for index in range(self.workers, workers):
+                self._spawn(index)
+            logger.info(f"worker 数 {self.workers} → {workers}")
+            self.workers = workers
+
+    async def stop(self):
+        """停止转发，所有 worker 处理完收到的更新后退出"""
+        async with self._routing:
+            for task in self._tasks[1:]:
+                task.cancel()
+            await asyncio.gather(*(self._stop_worker(i) for i in range(self.workers)))
+            self.workers = 0
+        self._outbox.put(("closed", None, None))
+        await self._tasks[0]
+
+
+def make_updater(token, base_url=None):
+    """只负责接收更新的 Updater（调度进程里不跑 handler）"""
+    kwargs = {"base_url": base_url} if base_url else {}
+    return Updater(Bot(token, **kwargs), asyncio.Queue())
+
+
+async def serve(token):
+    import bot
+
+    error = bot.webhook_config_error() if bot.BOT_MODE == "webhook" else None
+    if error:
+        logger.error(error)
+        return
+
+    supervisor = Supervisor(token)
+    await supervisor.start(BOT_WORKERS)
+
+    updater = make_updater(token)
+    await updater.initialize()
+    if bot.BOT_MODE == "webhook":
+        logger.info(f"webhook 模式：监听 {bot.WEBHOOK_LISTEN}:{bot.WEBHOOK_PORT}/{bot.WEBHOOK_PATH}")
+        await updater.start_webhook(**bot.webhook_options())
+    else:
+        await updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    dispatcher = asyncio.create_task(supervisor.dispatch(updater.update_queue))
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGUSR1, lambda: asyncio.create_task(supervisor.resize(supervisor.workers + 1)))
+    loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.create_task(supervisor.resize(supervisor.workers - 1)))
+    await stop.wait()
+
+    # 停止接收 → 转发完已收到的 → 各 worker 处理完再退出
+    await updater.stop()
+    await updater.update_queue.join()
+    dispatcher.cancel()
+    await supervisor.stop()
+    await updater.shutdown()
+    logger.info(f"各 worker 转发数：{dict(supervisor.routed)}")
+
+
+def main():
+    token = os.getenv("BOT_TOKEN")
+    if not token:
+        logger.error("BOT_TOKEN 未设置")
+        return
+    # 换 worker 的群要能拿到扩缩容前的待确认注单，进程内存存不住，默认放数据库
+    os.environ.setdefault("PENDING_STORE", "db")
+    asyncio.run(serve(token))
+
+
+# ---------- 本地测试 ----------
+
+async def _fake_run(n):
+    """
+    假 Telegram 上跑：2 个 worker 处理一轮，扩到 3 个再跑一轮。
+    检查每条消息都有回复、每个 worker 处理的正好是分给它的、扩容只迁走约 1/3 的群
+    """
+    from fake_telegram import FAKE_TOKEN, FakeBotAPI
+
+    api = FakeBotAPI()
+    api.start()
+    supervisor = Supervisor(FAKE_TOKEN, base_url=api.base_url)
+    await supervisor.start(2)
+    updater = make_updater(FAKE_TOKEN, base_url=api.base_url)
+    await updater.initialize()
+    await updater.start_polling(poll_interval=0, timeout=10)
+    dispatcher = asyncio.create_task(supervisor.dispatch(updater.update_queue))
+
+    chats = [-2000 - i for i in range(n)]
+    text = "08/06\nMKT\n1234-1B 1S"
+
+    async def one_round():
+        replies = [api.expect_reply(chat_id) for chat_id in chats]
+        start = time.perf_counter()
+        for chat_id in chats:
+            api.push_update(api.make_update(chat_id, text))
+        await asyncio.wait_for(asyncio.gather(*replies), 60)
+        return time.perf_counter() - start
+
+    try:
+        # 第一轮包含 worker 进程冷启动
+        first = await one_round()
+        before = {c: owner(c, 2) for c in chats}
+        await supervisor.resize(3)
+        second = await one_round()
+        after = {c: owner(c, 3) for c in chats}
+    finally:
+        await updater.stop()
+        await updater.update_queue.join()
+        dispatcher.cancel()
+        await supervisor.stop()
+        await updater.shutdown()
+        api.stop()
+
+    moved = sum(before[c] != after[c] for c in chats)
+    assert all(after[c] == 2 for c in chats if before[c] != after[c]), "扩容时群只应迁到新 worker"
+    handled = {i: s["handled"] for i, s in supervisor.worker_stats.items()}
+    expected = Counter(before.values()) + Counter(after.values())
+    assert handled == dict(expected) == dict(supervisor.routed), f"分片不一致：{handled} / {dict(expected)}"
+    pids = {s["pid"] for s in supervisor.worker_stats.values()}
+    assert len(pids) == 3, pids
+    print(f"2 个 worker：{n} 个群 {first * 1000:.0f} ms（含冷启动）")
+    print(f"3 个 worker：{n} 个群 {second * 1000:.0f} ms，扩容迁移 {moved}/{n} 个群")
+    print(f"各 worker 处理数：{handled}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--fake":
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+        tmp = tempfile.mkdtemp(prefix="4d-fake-tg-")
+        os.environ["SQLITE_PATH"] = os.path.join(tmp, "fake.db")
+        os.environ.setdefault("PENDING_STORE", "db")
+        asyncio.run(_fake_run(n))
+    else:
+        main()
@@ -0,0 +1,187 @@
+# update_processor.py
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from telegram.ext import BaseUpdateProcessor
+
+# 同时处理的更新数上限
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+# 按聊天统计最多保留的聊天数（最久没有更新的先淘汰）
+UPDATE_CHAT_STATS = int(os.getenv("UPDATE_CHAT_STATS", "1000"))
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    并发处理更新，但同一个聊天的更新严格按到达顺序逐条处理：
+    一个群的慢 handler（如确认下注写库）不会拖慢其它群，
+    同一个群里的注单和它的确认按钮也不会乱序。
+
+    先在 process_update 里排队拿聊天锁，轮到自己才交给父类 process_update
+    占用并发名额（max_concurrent_updates），排队中的更新不占名额。
+    """
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks = {}   # chat_id → [asyncio.Lock, 使用中 + 排队的更新数]
+        self._stats = {
+            "processed": 0,
+            "queued": 0,          # 当前排队（等聊天锁或并发名额）的更新数
+            "max_queued": 0,
+            "running": 0,
+            "max_running": 0,
+            "wait_total": 0.0,    # 排队总耗时（秒）
+            "wait_max": 0.0,
+        }
+        # chat_id → 该聊天的 processed / max_pending（处理中 + 排队的最大更新数）/ wait_total / wait_max
+        self._chat_stats = OrderedDict()
+        # 正在排队的更新 → (开始排队的时间, 该聊天的统计)，do_process_update 开始时取走
+        self._waiting = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self, top=5):
+        """计数器快照：队列深度、并发数、每个更新的排队时间，以及排队最久的 top 个聊天"""
+        s = dict(self._stats, chats=len(self._chat_locks))
+        s["wait_avg"] = s["wait_total"] / s["processed"] if s["processed"] else 0.0
+        s["slowest_chats"] = dict(self.chat_stats()[:top])
+        return s
+
+    def chat_stats(self):
+        """按聊天的计数器快照 [(chat_id, {...})]，按最长排队时间从大到小"""
+        return sorted(
+            ((chat_id, dict(cs)) for chat_id, cs in self._chat_stats.items()),
+            key=lambda item: item[1]["wait_max"],
+            reverse=True,
+        )
+
+    def _chat_entry(self, chat_id):
+        cs = self._chat_stats.get(chat_id)
+        if cs is None:
+            cs = self._chat_stats[chat_id] = {"processed": 0, "max_pending": 0, "wait_total": 0.0, "wait_max": 0.0}
+            while len(self._chat_stats) > UPDATE_CHAT_STATS:
+                self._chat_stats.popitem(last=False)
+        else:
+            self._chat_stats.move_to_end(chat_id)
+        return cs
+
+    async def process_update(self, update, coroutine) -> None:
+        chat = getattr(update, "effective_chat", None)
+        chat_id = chat.id if chat is not None else None
+
+        stats = self._stats
+        stats["queued"] += 1
+        stats["max_queued"] = max(stats["max_queued"], stats["queued"])
+
+        entry = chat_stats = None
+        if chat_id is not None:
+            entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+            entry[1] += 1
+            chat_stats = self._chat_entry(chat_id)
+            chat_stats["max_pending"] = max(chat_stats["max_pending"], entry[1])
+        key = id(coroutine)
+        self._waiting[key] = (time.perf_counter(), chat_stats)
+        try:
+            if entry is None:
+                await super().process_update(update, coroutine)
+            else:
+                async with entry[0]:
+                    await super().process_update(update, coroutine)
+        finally:
+            if self._waiting.pop(key, None) is not None:
+                # 排队中被取消
+                stats["queued"] -= 1
+                coroutine.close()
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._chat_locks[chat_id]
+
+    async def do_process_update(self, update, coroutine) -> None:
+        # 父类 process_update 拿到并发名额后调用
+        start, chat_stats = self._waiting.pop(id(coroutine))
+        stats = self._stats
+        waited = time.perf_counter() - start
+        stats["queued"] -= 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+        if chat_stats is not None:
+            chat_stats["processed"] += 1
+            chat_stats["wait_total"] += waited
+            chat_stats["wait_max"] = max(chat_stats["wait_max"], waited)
+        stats["running"] += 1
+        stats["max_running"] = max(stats["max_running"], stats["running"])
+        try:
+            await coroutine
+        finally:
+            stats["running"] -= 1
+            stats["processed"] += 1
+
+
+# ---------- 本地测试 ----------
+if __name__ == "__main__":
+    import random
+
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder, TypeHandler
+
+    from fake_telegram import FAKE_TOKEN, FakeBotAPI
+
+    async def main():
+        # 经由 Application 的更新队列分发，和线上 polling / webhook 走同一条路径
+        api = FakeBotAPI()
+        api.start()
+        processor = ChatOrderedUpdateProcessor(4)
+        app = (
+            ApplicationBuilder().token(FAKE_TOKEN).base_url(api.base_url)
+            .updater(None).concurrent_updates(processor).build()
+        )
+        done = {}
+        running = 0
+        peak = 0
+
+        async def handler(update, context):
+            nonlocal running, peak
+            chat_id, seq = update.effective_chat.id, int(update.message.text)
+            running += 1
+            peak = max(peak, running)
+            # 群 0 的 handler 很慢，模拟确认下注写库
+            await asyncio.sleep(0.2 if chat_id == 0 else random.uniform(0, 0.01))
+            running -= 1
+            done.setdefault(chat_id, []).append((seq, time.perf_counter()))
+
+        app.add_handler(TypeHandler(Update, handler))
+        await app.initialize()
+        await app.start()
+        start = time.perf_counter()
+        for seq in range(5):
+            for chat_id in range(6):
+                await app.update_queue.put(Update.de_json(api.make_update(chat_id, str(seq)), app.bot))
+        await app.update_queue.join()
+        await app.stop()
+        await app.shutdown()
+        api.stop()
+
+        assert sorted(done) == list(range(6)), done
+        for chat_id, items in done.items():
+            assert [seq for seq, _ in items] == list(range(5)), f"群 {chat_id} 乱序"
+        assert peak <= 4, f"并发 {peak} 超过上限"
+        # 慢群串行 5 × 0.2s；其它群不被它拖住，早早处理完
+        others = max(t for c, items in done.items() if c != 0 for _, t in items) - start
+        assert others < 0.2, f"其它群被慢群拖住：{others:.2f}s"
+        print(f"顺序与并发上限检查通过：峰值并发 {peak}，其它群 {others * 1000:.0f} ms 内处理完")
+        # 慢群排队最久：第 5 条要等前 4 条各 0.2s
+        slowest, cs = processor.chat_stats()[0]
+        assert slowest == 0 and cs["processed"] == 5 and cs["max_pending"] == 5, processor.chat_stats()[0]
+        assert cs["wait_max"] > 0.7, cs
+        stats = processor.stats()
+        assert stats["processed"] == 30 and stats["queued"] == 0 and stats["max_running"] <= 4, stats
+        print(f"统计：{stats}")
+
+    asyncio.run(main())
@@ -1,37 +1,129 @@
-from db import get_locked_bets_for_date
-
-def check_group_winning(chat_id, results_data, date_str):
-    results = {
-        key[1]: results_data[key] 
-        for key in results_data if key[0] == date_str
-    }
-    if not results:
-        return []
-
-    bets = get_locked_bets_for_date(chat_id, date_str)
-    winnings = []
-
-    for bet in bets:
-        number = bet.number
-        market = bet.market
-        bet_type = bet.bet_type
-        amount = bet.amount
-        key = (date_str, market)
-
-        if key not in results_data:
-            continue
-
-        result_text = results_data[key]
-        for line in result_text.splitlines():
-            if ":" in line:
-                title, numbers = line.split(":")
-                numbers = numbers.strip().split()
-                if number in numbers:
-                    prize = title.strip()
-                    winnings.append({
-                        "number": number,
-                        "prize_type": prize,
-                        "amount": amount * 1.0  # 可根据 prize 类型给不同赔率
-                    })
-
-    return winnings
+import os
+import threading
+from collections import OrderedDict
+
+from db import get_group_winnings
+from engine import COMMISSION_RATES, STANDARD_ODDS, calculate
+from parser import iter_bet_text
+
+def check_group_winning(chat_id, date_str):
+    """
+    某群某日的中奖注单：开奖录入时 db.settle_draw 已在数据库里
+    一次结算好所有群，这里只读取结果。
+    """
+    return [
+        {
+            "number": w["number"],
+            "market": w["market"],
+            "prize_type": w["prize"],
+            "amount": float(w["payout"]),
+        }
+        for w in get_group_winnings(chat_id, date_str)
+    ]
+
+
+# ✅ 注单解析 + 计价缓存：代理常把同一张注单改个错字重发、或转发到多个群，
+#    相同文本直接返回上次算好的结果（LRU，按条数限额）
+SLIP_CACHE_SIZE = int(os.getenv("SLIP_CACHE_SIZE", "512"))
+SLIP_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+_slip_cache = OrderedDict()
+_slip_cache_lock = threading.Lock()
+_slip_cache_odds = None
+
+def _odds_version():
+    """赔率 / 佣金表的指纹，任何一项改动都会让旧缓存失效"""
+    return repr((STANDARD_ODDS, COMMISSION_RATES))
+
+def _normalize_slip(text: str) -> str:
+    # 去掉行尾空白和结尾空行：不影响解析结果，也不改变未识别 token 的行列号
+    return "\n".join(line.rstrip() for line in text.splitlines()).rstrip()
+
+def _copy_priced(bets, summary, unparsed):
+    # bet dict 和 markets 列表都会被调用方改写，缓存里的和交出去的各留一份
+    return (
+        [dict(b, markets=list(b["markets"])) for b in bets],
+        dict(summary),
+        list(unparsed),
+    )
+
+def price_slip(text: str, default_year: int = 2025):
+    """
+    解析并计价一张注单，返回 (bets, summary, unparsed)：
+      - bets / summary 同 engine.calculate 回写后的注单和汇总
+      - unparsed 同 parser.iter_bet_text 收集的 (行, 列, token)
+    格式错误照常抛 ValueError（错误不缓存）。
+
+    结果按 (规范化文本, 年份) 缓存；每次返回的都是副本，调用方随意修改不影响缓存。
+    STANDARD_ODDS / COMMISSION_RATES 变化时整个缓存自动作废。
+    """
+    global _slip_cache_odds
+    key = (_normalize_slip(text), default_year)
+    version = _odds_version()
+
+    with _slip_cache_lock:
+        if version != _slip_cache_odds:
+            if _slip_cache:
+                SLIP_CACHE_STATS["invalidations"] += 1
+            _slip_cache.clear()
+            _slip_cache_odds = version
+        entry = _slip_cache.get(key)
+        if entry is not None:
+            _slip_cache.move_to_end(key)
+            SLIP_CACHE_STATS["hits"] += 1
+            return _copy_priced(*entry)
+        SLIP_CACHE_STATS["misses"] += 1
+
+    unparsed = []
+    bets = list(iter_bet_text(text, default_year=default_year, unparsed=unparsed))
+    summary = calculate(bets)
+    entry = _copy_priced(bets, summary, unparsed)
+
+    with _slip_cache_lock:
+        # 计价期间赔率被改过的话，这份结果不再入缓存
+        if version == _slip_cache_odds:
+            _slip_cache[key] = entry
+            _slip_cache.move_to_end(key)
+            while len(_slip_cache) > SLIP_CACHE_SIZE:
+                _slip_cache.popitem(last=False)
+                SLIP_CACHE_STATS["evictions"] += 1
+    return bets, summary, unparsed
+
+def slip_cache_stats():
+    """返回注单缓存计数器快照（含当前条数）"""
+    with _slip_cache_lock:
+        return dict(SLIP_CACHE_STATS, size=len(_slip_cache))
+
+def clear_slip_cache():
+    with _slip_cache_lock:
+        _slip_cache.clear()
+
+
+# ---------- 本地测试 ----------
+if __name__ == "__main__":
+    slip = "08/06\nMKT\n1234-1B 1S\n5678-2B box\n"
+
+    bets, summary, unparsed = price_slip(slip)
+    assert slip_cache_stats()["misses"] == 1
+
+    # 行尾空白不同也算同一张注单；修改返回值不影响缓存
+    bets[0]["amount"] = 999
+    bets[0]["markets"].append("H")
+    summary["total_amount"] = 0
+    again, summary2, _ = price_slip(slip.replace("\n", "  \n"))
+    assert slip_cache_stats()["hits"] == 1
+    assert again[0]["amount"] == 1 and again[0]["markets"] == ["M", "K", "T"]
+    assert summary2 == calculate(list(iter_bet_text(slip)))
+
+    # 改赔率 → 缓存作废，重新计价
+    STANDARD_ODDS["M"]["B"] += 1
+    price_slip(slip)
+    STANDARD_ODDS["M"]["B"] -= 1
+    assert slip_cache_stats()["invalidations"] == 1
+
+    # 超过容量淘汰最久未用的
+    for i in range(SLIP_CACHE_SIZE + 3):
+        price_slip(f"08/06\nMKT\n{i:04d}-1B")
+    assert slip_cache_stats()["evictions"] >= 3
+    assert slip_cache_stats()["size"] == SLIP_CACHE_SIZE
+    print(f"注单缓存自测通过：{slip_cache_stats()}")